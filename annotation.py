@@ -0,0 +1,476 @@
+#!/usr/bin/env python3
+
+
+#########
+# about #
+#########
+
+__version__ = "0.1.0"
+__author__ = ["Nikolaos Karaiskos","Marcel Schilling"]
+__credits__ = ["Nikolaos Karaiskos","Mireya Plass Pórtulas","Marcel Schilling","Nikolaus Rajewsky"]
+__status__ = "beta"
+__licence__ = "GPL"
+__email__ = "marcel.schilling@mdc-berlin.de"
+
+
+###########
+# imports #
+###########
+
+import gzip
+import itertools
+import queue
+import threading
+import os
+import sys
+import re
+import bisect
+import io
+import struct
+import zlib
+import collections
+import contextlib
+import types
+from collections import defaultdict
+
+
+#############
+# functions #
+#############
+
+# Reading (compressed) text files and the text-only annotation stages
+# (GTF to 3'UTR BED, pAi scan and annotation, gene selection). Only
+# light-weight modules are imported, no numpy, so that the corresponding
+# commands of polyA.py start quickly as stages of a pipe. estimate_length
+# re-exports everything.
+
+# Test if a file is gzip compressed or not
+def is_gzip_file(filename):
+    try:
+        # This will raise OSError for uncompressed files & has no side
+        # effects for compressed files:
+        gzip.GzipFile(filename).peek(1)
+        return True
+    except OSError:
+        return False
+
+# Open a file (gzip compressed or not) for iterating over its lines; '-'
+# refers to standard input. Lines are read via read_lines (decompression
+# in background threads, decoding whole blocks at once).
+def open_file(filename):
+    return contextlib.closing(read_lines(filename))
+
+# Magic bytes starting every gzip member
+gzip_magic = b'\x1f\x8b'
+
+def bgzf_blocks(f):
+    """Yields the compressed BGZF blocks (complete gzip members) of the
+       binary file object f, using the block sizes stored in their headers
+       without decompressing."""
+    while True:
+        header = f.read(12)
+        if len(header) == 0:
+            return
+        if len(header) < 12 or header[:2] != gzip_magic:
+            raise ValueError('truncated or invalid BGZF block')
+        extra_length = struct.unpack('<H', header[10:12])[0]
+        extra = f.read(extra_length)
+        block_size = None
+        position = 0
+        while position + 4 <= len(extra):
+            subfield_length = struct.unpack('<H', extra[position + 2:
+                                                       position + 4])[0]
+            if extra[position:position + 2] == b'BC':
+                block_size = struct.unpack('<H', extra[position + 4:
+                                                       position + 6])[0] + 1
+            position += 4 + subfield_length
+        if block_size is None:
+            raise ValueError('gzip member without BGZF block size')
+        yield header + extra + f.read(block_size - 12 - extra_length)
+
+def inflate_bgzf_block(block):
+    """Decompresses a single BGZF block as yielded by bgzf_blocks."""
+    extra_length = struct.unpack('<H', block[10:12])[0]
+    return zlib.decompress(block[12 + extra_length:-8], -zlib.MAX_WBITS)
+
+def is_bgzf(head):
+    """Tests if the first bytes of a file start a BGZF block."""
+    return (len(head) >= 16 and head[:2] == gzip_magic
+            and head[3] & 4 != 0 and head[12:14] == b'BC')
+
+def read_raw_blocks(f, block_size):
+    while True:
+        block = f.read(block_size)
+        if not block:
+            return
+        yield block
+
+def inflate_gzip_members(f, block_size):
+    """Decompresses all (possibly multiple) gzip members of the binary file
+       object f sequentially, yielding decompressed byte blocks. Raises an
+       EOFError (like gzip) if the last member is truncated."""
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    # Whether the current member received any input
+    started = False
+    for block in read_raw_blocks(f, block_size):
+        while block:
+            started = True
+            data = decompressor.decompress(block)
+            if data:
+                yield data
+            if not decompressor.eof:
+                break
+            block = decompressor.unused_data
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            started = False
+    data = decompressor.flush()
+    if data:
+        yield data
+    if started and not decompressor.eof:
+        raise EOFError('Compressed file ended before the end-of-stream '
+                       'marker was reached')
+
+def inflate_bgzf_parallel(f, blocks_per_task, queue_size, threads):
+    """Decompresses the BGZF blocks of the binary file object f in parallel
+       (zlib releases the GIL), keeping at most queue_size tasks of
+       blocks_per_task blocks in flight and yielding the results in order."""
+    from concurrent.futures import ThreadPoolExecutor
+    tasks = collections.deque()
+    blocks = bgzf_blocks(f)
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        while True:
+            while len(tasks) < queue_size:
+                task = list(itertools.islice(blocks, blocks_per_task))
+                if not task:
+                    break
+                tasks.append(executor.submit(
+                    lambda task: b''.join(inflate_bgzf_block(block)
+                                          for block in task), task))
+            if not tasks:
+                return
+            yield tasks.popleft().result()
+
+def prepend(head, f):
+    """Returns a file object (supporting read only) reading the bytes head
+       followed by the rest of the binary file object f."""
+    pending = [head]
+    def read(size=-1):
+        data = pending[0] if size < 0 else pending[0][:size]
+        pending[0] = pending[0][len(data):]
+        if not data:
+            return f.read(size)
+        if size < 0 or len(data) < size:
+            data += f.read(-1 if size < 0 else size - len(data))
+        return data
+    return types.SimpleNamespace(read=read)
+
+def read_blocks(filename, block_size=1 << 22, queue_size=8, threads=None):
+    """Yields the (decompressed) content of a file as large byte blocks for
+       bulk parsing, '-' referring to standard input. Decompression runs in
+       background threads filling a buffer of at most queue_size blocks:
+       BGZF files are decompressed in parallel (by about block_size bytes
+       per task), other gzip files (also multi-member) sequentially, plain
+       files are passed through."""
+    if filename == '-':
+        f = open(sys.stdin.fileno(), 'rb', closefd=False)
+    else:
+        f = open(filename, 'rb')
+    with f:
+        # Unlike peek, read returns fewer bytes only at the end of the file,
+        # also on pipes delivering data in small pieces
+        head = f.read(18)
+        f = prepend(head, f)
+        if is_bgzf(head):
+            # BGZF blocks hold at most 64 kB of uncompressed data
+            blocks = inflate_bgzf_parallel(f, max(1, block_size >> 16),
+                                           queue_size,
+                                           threads or os.cpu_count())
+        elif head[:2] == gzip_magic:
+            blocks = prefetch(inflate_gzip_members(f, block_size), queue_size)
+        else:
+            blocks = prefetch(read_raw_blocks(f, block_size), queue_size)
+        for block in blocks:
+            yield block
+
+def read_lines(filename, **kwargs):
+    """Iterates over the lines of a file (gzip compressed or not), reading
+       via read_blocks and decoding whole blocks at once."""
+    rest = b''
+    for block in read_blocks(filename, **kwargs):
+        block = rest + block
+        end = block.rfind(b'\n') + 1
+        rest = block[end:]
+        for line in io.StringIO(block[:end].decode()):
+            yield line
+    if rest:
+        yield rest.decode()
+
+
+# Iterate over an iterable in a background thread, buffering at most
+# queue_size items, so that producing the next items (e.g. parsing input)
+# overlaps with consuming the current ones (e.g. estimation)
+def prefetch(iterable, queue_size):
+    buffer = queue.Queue(maxsize=queue_size)
+    done = object()
+    errors = []
+
+    def produce():
+        try:
+            for item in iterable:
+                buffer.put(item)
+        except Exception as error:
+            errors.append(error)
+        finally:
+            buffer.put(done)
+
+    # Daemon thread: abandoning the iterator must not block interpreter
+    # exit on a full buffer
+    threading.Thread(target=produce, daemon=True).start()
+    while True:
+        item = buffer.get()
+        if item is done:
+            break
+        yield item
+    if errors:
+        raise errors[0]
+
+
+# Read annotation from GTF file
+# This will output BED to output (STDOUT by default)
+def extract_three_prime_utr_information(gtf_file,
+                                        bed_name_attributes = ["gene_id",
+                                                               "gene_name"],
+                                        bed_name_separator = "|",
+                                        feature_utr3 = "three_prime_utr",
+                                        feature_gene = "gene",
+                                        feature_transcript = "transcript",
+                                        feature_exon = "exon",
+                                        output = None):
+
+    # Resolve STDOUT at call time to respect redirections
+    if output is None:
+        output = sys.stdout
+
+    # The following parameters define the parsing of the input GTF file.
+    # They were chosen according to the standard described in
+    # http://genome.ucsc.edu/FAQ/FAQformat.html#format4.
+
+    # Lines starting with the following character will be skipped:
+    comment_char = '#'
+
+    # Lines will be split into fields by the following character:
+    field_separator = '\t'
+
+    # The attributes field will be split into type/value pairs by the
+    # following string:
+    attributes_separator = "; "
+
+    # The attribute with the following index will be used as gene ID:
+    attribute_index_gene_id = 0
+
+    # Attribute type/value pairs will be split by the following
+    # character:
+    attribute_separator = ' "'
+
+    # The following index will be used to get the value of an attribute
+    # type/value pair:
+    attribute_value_index = 1
+
+    # The following character will be removed from the beginning and end
+    # of attribute values:
+    attribute_value_quote = '"'
+
+    # The following character will be used to separte fields in the BED
+    # output:
+    bed_separator = '\t'
+
+    # This set will be used to store all 3' UTR BED entries for the
+    # current gene.
+    three_prime_utrs = set()
+
+    # Read GTF input line by line
+    with open_file(gtf_file) as gtf:
+        for line in gtf:
+
+            # Skip comment lines
+            if (line[0] == comment_char):
+                continue
+
+            # Split lines into fields
+            (seqname, source, feature, start, end, score, strand, frame,
+                attributes) = line.rstrip().split(field_separator)
+
+            # Output BED line for each (different) 3' UTR isoform of the
+            # previous gene & re-initialize 3' UTR set for current gene
+            if (feature == feature_gene):
+                for three_prime_utr in three_prime_utrs:
+                    print(bed_separator.join(str(field) for field in
+                                             three_prime_utr), file=output)
+                three_prime_utrs = set()
+                continue
+
+            # Re-initialize extension length for new transcripts
+            if (feature == feature_transcript):
+                extension_length=0
+                continue
+
+            # Convert from 1-based closed to 0-based open intervals
+            start = (int(start) - 1)
+            end = int(end)
+
+            # Store coordinates of last exon of the current transcript
+            if (feature == feature_exon):
+                exon=dict(start = start, end = end)
+                continue
+
+            # Skip lines not defining 3' UTRs
+            if (feature != feature_utr3):
+                continue
+
+            # Split attributes into type/value pairs
+            attributes = attributes.split(attributes_separator)
+            attributes = [attribute.rstrip(attributes_separator) for attribute
+                          in attributes]
+            attributes = [attribute.split(attribute_separator) for attribute in
+                          attributes]
+            attributes = dict((key, value[:-1]) for (key, value) in attributes)
+
+            # Construct BED name field from specified GTF attributes
+            gene=bed_name_separator.join(attributes[attribute] for attribute in
+                                         bed_name_attributes)
+
+            # Count 3' UTR nucleotides in upstream exons
+            if (strand == "+" and exon["end"] != end) or \
+               (strand == "-" and exon["start"] != start):
+                extension_length -= end - start
+
+            # Determine number of extra nucleotides in last exon
+            # compared to 3' UTR only
+            else:
+                if (strand == "+"):
+                    extension_length += start - exon["start"]
+                else:
+                    extension_length += exon["end"] - end
+
+            # Append current 3' UTR to 3' UTRs of current gene (if not
+            # seen before) replacing the coordinates by those of the
+            # last exon and the score by the number of nucleotides added
+            # to the 3' UTR by this extension (negative for spliced 3'
+            # UTRs)
+            three_prime_utrs.add((seqname, exon["start"], exon["end"], gene,
+                                  strand, extension_length))
+
+    # Output BED line for each (different) 3' UTR isoform of the last
+    # gene
+    for three_prime_utr in three_prime_utrs:
+        print(bed_separator.join(str(field) for field in three_prime_utr),
+              file=output)
+
+
+def scan_pAi(genome, window, occurences, consecutive):
+    """Streaming version of extract_pAi_from_genome: yields the merged pAi
+       (chromosome, start, end, strand) found in the FASTA lines genome,
+       without temporary files. Unlike extract_pAi_from_genome, this also
+       yields the last interval and never merges across chromosomes."""
+    previous = None
+    for interval in scan_pAi_windows(genome, window, occurences,
+                                     consecutive):
+        if (previous is not None and interval[0] == previous[0]
+                and interval[3] == previous[3]
+                and previous[1] < interval[1] <= previous[2]):
+            previous[2] = interval[2]
+            continue
+        if previous is not None:
+            yield tuple(previous)
+        previous = list(interval)
+    if previous is not None:
+        yield tuple(previous)
+
+def scan_pAi_windows(genome, window, occurences, consecutive):
+    """Yields every window (chromosome, start, end, strand) of the FASTA
+       lines genome that qualifies as pAi as in extract_pAi_from_genome."""
+    for line in genome:
+        line = line.rstrip('\n')
+        if '>' in line:
+            chromosome = str(line.split()[0][1:])
+            genomic_coordinate = 0
+            prefix = ''
+            continue
+        line = prefix + line
+        c = 0
+        while c <= len(line)-window:
+            segment = line[c:(c+window)]
+            if consecutive*'A' in segment or segment.count('A') >= occurences:
+                yield (chromosome, genomic_coordinate,
+                       genomic_coordinate+window, '+')
+            elif (consecutive*'T' in segment
+                    or segment.count('T') >= occurences):
+                yield (chromosome, genomic_coordinate,
+                       genomic_coordinate+window, '-')
+            c += 1
+            genomic_coordinate += 1
+        prefix = line[c:]
+
+def utr_gene_spans(utr_bed):
+    """Returns the region spanned by all 3'UTRs of each gene in the UTR BED
+       lines utr_bed as {(chromosome, strand) : [(start, end, gene), ...]}
+       sorted by start."""
+    genes = {}
+    for line in utr_bed:
+        chr, start, end, gene, strand = line.rstrip('\n').split('\t')[:5]
+        if gene in genes:
+            chr, strand, gene_start, gene_end = genes[gene]
+            genes[gene] = (chr, strand, min(gene_start, int(start)),
+                           max(gene_end, int(end)))
+        else:
+            genes[gene] = (chr, strand, int(start), int(end))
+    spans = defaultdict(list)
+    for gene, (chr, strand, start, end) in genes.items():
+        spans[(chr, strand)].append((start, end, gene))
+    for block in spans.values():
+        block.sort()
+    return dict(spans)
+
+def annotate_pAi(pAi_bed, spans):
+    """Streaming version of annotate_pAi_with_gene: yields one (chromosome,
+       start, end, gene, strand) for each gene span (see utr_gene_spans)
+       fully containing a pAi of the BED lines pAi_bed on the same strand.
+       Neither input needs to be sorted."""
+    starts = dict((key, [span[0] for span in block])
+                  for key, block in spans.items())
+    max_lengths = dict((key, max(span[1] - span[0] for span in block))
+                       for key, block in spans.items())
+    for line in pAi_bed:
+        chr, start, end, name, strand = line.rstrip('\n').split('\t')[:5]
+        strand = strand.strip()
+        key = (chr, strand)
+        if key not in spans:
+            continue
+        start = int(start)
+        end = int(end)
+        first = bisect.bisect_left(starts[key], end - max_lengths[key])
+        last = bisect.bisect_right(starts[key], start)
+        for span_start, span_end, gene in spans[key][first:last]:
+            if span_end >= end:
+                yield chr, start, end, gene, strand
+
+def single_utr_genes(gtf, attribute='gene_name', feature_utr3='three_prime_utr'):
+    """Returns the set of genes with exactly one 3'UTR entry in the GTF
+       lines gtf, genes being identified by the given attribute."""
+    pattern = re.compile(attribute + ' "([^"]*)"')
+    counts = defaultdict(int)
+    for line in gtf:
+        if line[0] == '#':
+            continue
+        fields = line.split('\t')
+        if fields[2] != feature_utr3:
+            continue
+        counts[pattern.search(fields[8]).group(1)] += 1
+    return set(gene for gene, count in counts.items() if count == 1)
+
+def single_utr_no_pAi_genes(gtf, pAi_gene_bed, attribute='gene_name'):
+    """Returns the sorted list of genes with a single 3'UTR entry in the GTF
+       lines gtf and no pAi in the gene annotated pAi BED lines
+       pAi_gene_bed."""
+    pAi_genes = set(line.split('\t')[3] for line in pAi_gene_bed)
+    return sorted(single_utr_genes(gtf, attribute) - pAi_genes)
@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+
+
+#########
+# about #
+#########
+
+__version__ = "0.1.0"
+__author__ = ["Nikolaos Karaiskos","Marcel Schilling"]
+__credits__ = ["Nikolaos Karaiskos","Mireya Plass Pórtulas","Marcel Schilling","Nikolaus Rajewsky"]
+__status__ = "beta"
+__licence__ = "GPL"
+__email__ = "marcel.schilling@mdc-berlin.de"
+
+
+###########
+# imports #
+###########
+
+import os
+import struct
+import numpy as np
+from annotation import read_blocks, bgzf_blocks, inflate_bgzf_block
+
+
+#############
+# functions #
+#############
+
+# Decoding of BAM files (see https://samtools.github.io/hts-specs/SAMv1.pdf)
+# without samtools, keeping only the fields needed for the tail length
+# estimation: position (1-based as in SAM), strand, gene tag and UMI tag.
+# The default tags are those set by Drop-seq tools.
+
+# Sizes of fixed size tag values by type
+tag_value_sizes = {'A' : 1, 'c' : 1, 'C' : 1, 's' : 2, 'S' : 2, 'i' : 4,
+                   'I' : 4, 'f' : 4}
+
+# Formats of fixed size tag values by type
+tag_value_formats = {'A' : '<c', 'c' : '<b', 'C' : '<B', 's' : '<h',
+                     'S' : '<H', 'i' : '<i', 'I' : '<I', 'f' : '<f'}
+
+def parse_bam_header(data):
+    """Parses the header of a BAM file from its first decompressed bytes.
+       Returns the reference names and the offset of the first record, or
+       None if data is too short."""
+    if len(data) < 12:
+        return None
+    if data[:4] != b'BAM\x01':
+        raise ValueError('not a BAM file')
+    text_length = struct.unpack_from('<i', data, 4)[0]
+    offset = 8 + text_length
+    if len(data) < offset + 4:
+        return None
+    n_references = struct.unpack_from('<i', data, offset)[0]
+    offset += 4
+    references = []
+    for reference in range(n_references):
+        if len(data) < offset + 4:
+            return None
+        name_length = struct.unpack_from('<i', data, offset)[0]
+        if len(data) < offset + name_length + 8:
+            return None
+        references.append(data[(offset + 4):(offset + 3 + name_length)]
+                          .decode())
+        offset += 8 + name_length
+    return references, offset
+
+def parse_bam_tags(data, offset, end, tags):
+    """Returns the values of the requested tags (None if missing) of the
+       tag section data[offset:end] of a BAM record."""
+    values = dict((tag, None) for tag in tags)
+    while offset < end:
+        tag = data[offset:(offset + 2)].decode()
+        value_type = chr(data[offset + 2])
+        offset += 3
+        if value_type in tag_value_sizes:
+            if tag in values:
+                values[tag] = struct.unpack_from(tag_value_formats[value_type],
+                                                 data, offset)[0]
+                if value_type == 'A':
+                    values[tag] = values[tag].decode()
+            offset += tag_value_sizes[value_type]
+        elif value_type in 'ZH':
+            value_end = data.index(b'\x00', offset)
+            if tag in values:
+                values[tag] = data[offset:value_end].decode()
+            offset = value_end + 1
+        elif value_type == 'B':
+            array_type = chr(data[offset])
+            length = struct.unpack_from('<i', data, offset + 1)[0]
+            offset += 5 + length * tag_value_sizes[array_type]
+        else:
+            raise ValueError('invalid BAM tag type %r' % value_type)
+    return values
+
+def parse_bam_record(data, offset, tags):
+    """Parses the BAM record starting at data[offset]. Returns the reference
+       index, 0-based position, reverse strand flag, requested tag values
+       and the offset of the next record."""
+    block_size, reference, position, name_length, _, _, n_cigar, flag, \
+        sequence_length = struct.unpack_from('<iiiBBHHHi', data, offset)
+    end = offset + 4 + block_size
+    tag_offset = (offset + 36 + name_length + 4 * n_cigar
+                  + (sequence_length + 1) // 2 + sequence_length)
+    return (reference, position, bool(flag & 16),
+            parse_bam_tags(data, tag_offset, end, tags), end)
+
+def bam_records(blocks, tags):
+    """Yields (reference index, 0-based position, reverse, tag values) for
+       all records in the decompressed BAM byte blocks."""
+    data = b''
+    offset = 0
+    header = None
+    for block in blocks:
+        data = data[offset:] + block
+        offset = 0
+        if header is None:
+            header = parse_bam_header(data)
+            if header is None:
+                continue
+            offset = header[1]
+        while len(data) >= offset + 4:
+            block_size = struct.unpack_from('<i', data, offset)[0]
+            if len(data) < offset + 4 + block_size:
+                break
+            reference, position, reverse, values, offset = \
+                parse_bam_record(data, offset, tags)
+            yield reference, position, reverse, values
+    if header is None:
+        raise ValueError('truncated BAM header')
+
+def bam_records_at(f, virtual_offset, tags):
+    """Yields (virtual offset, reference index, 0-based position, reverse,
+       tag values) for the records of the open BAM file f from the given
+       BGZF virtual offset on."""
+    block_offset = virtual_offset >> 16
+    f.seek(block_offset)
+    blocks = bgzf_blocks(f)
+    data = b''
+    offset = virtual_offset & 0xffff
+    # (start in data, file offset) of the BGZF blocks data consists of
+    starts = []
+    while True:
+        # Drop blocks before the current record
+        while len(starts) > 1 and starts[1][0] <= offset:
+            cut = starts[1][0]
+            data = data[cut:]
+            offset -= cut
+            starts = [(start - cut, block) for start, block in starts[1:]]
+        if (len(data) < offset + 4 or len(data) < offset + 4
+                + struct.unpack_from('<i', data, offset)[0]):
+            block = next(blocks, None)
+            if block is None:
+                return
+            starts.append((len(data), block_offset))
+            block_offset += len(block)
+            data += inflate_bgzf_block(block)
+            continue
+        record_offset = (starts[0][1] << 16) | offset
+        reference, position, reverse, values, offset = \
+            parse_bam_record(data, offset, tags)
+        yield record_offset, reference, position, reverse, values
+
+def read_bam_references(bamfile):
+    """Returns the reference names of a BAM file."""
+    with open(bamfile, 'rb') as f:
+        data = b''
+        for block in bgzf_blocks(f):
+            data += inflate_bgzf_block(block)
+            header = parse_bam_header(data)
+            if header is not None:
+                return header[0]
+    raise ValueError('truncated BAM header')
+
+def read_bam(bamfile, gene_tag='GE', umi_tag='XM', **kwargs):
+    """Reads all records of a BAM file (decompressed in parallel by
+       read_blocks, see there for kwargs) into a dictionary of arrays:
+       'reference' (name), 'position' (1-based), 'strand' ('+'/'-'),
+       'gene' and 'umi' (None for missing tags)."""
+    references = []
+    positions = []
+    strands = []
+    genes = []
+    umis = []
+    records = bam_records(read_blocks(bamfile, **kwargs), [gene_tag, umi_tag])
+    for reference, position, reverse, values in records:
+        references.append(reference)
+        positions.append(position + 1)
+        strands.append('-' if reverse else '+')
+        genes.append(values[gene_tag])
+        umis.append(values[umi_tag])
+    names = np.array(read_bam_references(bamfile) + [None], dtype=object)
+    return {'reference' : names[np.array(references, dtype=int)],
+            'position' : np.array(positions, dtype=np.int64),
+            'strand' : np.array(strands, dtype='U1'),
+            'gene' : np.array(genes, dtype=object),
+            'umi' : np.array(umis, dtype=object)}
+
+def read_bai(bai):
+    """Reads a BAI index. Returns one (bins, linear index) tuple per
+       reference, bins mapping bin numbers to lists of (begin, end) virtual
+       offset chunks."""
+    with open(bai, 'rb') as f:
+        data = f.read()
+    if data[:4] != b'BAI\x01':
+        raise ValueError('not a BAI file: %s' % bai)
+    n_references = struct.unpack_from('<i', data, 4)[0]
+    offset = 8
+    index = []
+    for reference in range(n_references):
+        n_bins = struct.unpack_from('<i', data, offset)[0]
+        offset += 4
+        bins = {}
+        for bin in range(n_bins):
+            bin_number, n_chunks = struct.unpack_from('<Ii', data, offset)
+            offset += 8
+            chunks = struct.unpack_from('<%iQ' % (2 * n_chunks), data, offset)
+            offset += 16 * n_chunks
+            bins[bin_number] = list(zip(chunks[::2], chunks[1::2]))
+        n_intervals = struct.unpack_from('<i', data, offset)[0]
+        offset += 4
+        linear = struct.unpack_from('<%iQ' % n_intervals, data, offset)
+        offset += 8 * n_intervals
+        index.append((bins, linear))
+    return index
+
+def region_to_bins(start, end):
+    """Returns the BAI bins overlapping the 0-based region [start, end) (see
+       reg2bins in the SAM specification)."""
+    end -= 1
+    bins = [0]
+    for shift, first in [(26, 1), (23, 9), (20, 73), (17, 585), (14, 4681)]:
+        bins.extend(range(first + (start >> shift), first + (end >> shift) + 1))
+    return bins
+
+def fetch_bam_region(f, index, reference, start, end, tags):
+    """Yields (0-based position, reverse, tag values) of all records of the
+       open BAM file f on the given reference index starting within the
+       0-based region [start, end), reading only the BGZF blocks the BAI
+       index points to."""
+    bins, linear = index[reference]
+    if start >> 14 < len(linear):
+        min_offset = linear[start >> 14]
+    else:
+        min_offset = 0
+    chunks = sorted(chunk for bin in region_to_bins(start, end)
+                    for chunk in bins.get(bin, [])
+                    if chunk[1] > min_offset)
+    merged = []
+    for chunk_start, chunk_end in chunks:
+        chunk_start = max(chunk_start, min_offset)
+        if merged and chunk_start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], chunk_end)
+        else:
+            merged.append([chunk_start, chunk_end])
+    for chunk_start, chunk_end in merged:
+        for record_offset, record_reference, position, reverse, values \
+                in bam_records_at(f, chunk_start, tags):
+            if (record_offset >= chunk_end or record_reference != reference
+                    or position >= end):
+                break
+            if position >= start:
+                yield position, reverse, values
+
+def read_bam_by_gene(bamfile, spans, gene_tag='GE', umi_tag='XM',
+                     bai=None):
+    """Yields one (gene, reads) tuple per gene span (see utr_gene_spans),
+       reads being [position, strand, UMI] lists like those yielded by
+       read_bamfile_by_gene for all reads within the span tagged with the
+       gene. If a BAI index (default: bamfile + '.bai') exists, only the
+       parts of the BAM file overlapping the spans are read."""
+    if bai is None:
+        bai = bamfile + '.bai'
+    if not os.path.isfile(bai):
+        reads = read_bam(bamfile, gene_tag, umi_tag)
+        by_gene = {}
+        for read, gene in enumerate(reads['gene']):
+            by_gene.setdefault(gene, []).append(read)
+        for (chr, strand), block in sorted(spans.items()):
+            for start, end, gene in block:
+                yield gene, [[str(reads['position'][read]),
+                              str(reads['strand'][read]), reads['umi'][read]]
+                             for read in by_gene.get(gene, [])
+                             if reads['reference'][read] == chr
+                             and start < reads['position'][read] <= end]
+        return
+    references = dict((name, index) for index, name
+                      in enumerate(read_bam_references(bamfile)))
+    index = read_bai(bai)
+    with open(bamfile, 'rb') as f:
+        for (chr, strand), block in sorted(spans.items()):
+            for start, end, gene in block:
+                if chr not in references:
+                    yield gene, []
+                    continue
+                yield gene, [[str(position + 1), '-' if reverse else '+',
+                              values[umi_tag]]
+                             for position, reverse, values
+                             in fetch_bam_region(f, index, references[chr],
+                                                 start, end,
+                                                 [gene_tag, umi_tag])
+                             if values[gene_tag] == gene]
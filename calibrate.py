@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+
+
+#########
+# about #
+#########
+
+__version__ = "0.1.0"
+__author__ = ["Nikolaos Karaiskos","Marcel Schilling"]
+__credits__ = ["Nikolaos Karaiskos","Mireya Plass Pórtulas","Marcel Schilling","Nikolaus Rajewsky"]
+__status__ = "beta"
+__licence__ = "GPL"
+__email__ = "marcel.schilling@mdc-berlin.de"
+
+
+###########
+# imports #
+###########
+
+import time
+import numpy as np
+from estimate_length import (discretize_bioanalyzer_profile,
+                             tail_length_range, likelihood_table,
+                             banded_likelihood_table,
+                             estimate_tail_lengths_streaming)
+from simulate import simulate_reads
+
+
+#############
+# functions #
+#############
+
+# Calibrates the speed/accuracy settings of the tail length estimation on
+# simulated genes: For each true tail length distribution and coverage,
+# genes are simulated with simulate_reads from the bioanalyzer profile at
+# 1 nt resolution, each gene drawing its tail length from the
+# distribution. The genes are then estimated by
+# estimate_tail_lengths_streaming, as by the estimate command of polyA.py,
+# with each setting, a dictionary of
+#   bin_size:          bin size of the discretized bioanalyzer profile
+#   tail_step:         spacing of the tail length grid
+#   max_reads:         maximal number of reads used per gene (None: all)
+#   stop_probability:  stop adding reads (in batches) once the posterior
+#                      of the MAP tail length reaches this (None: never)
+#   banded:            evaluate the banded likelihood table
+# and the errors of the MAP and mean tail lengths, the coverage of the
+# central credible interval and the runtime per gene are reported.
+
+# Columns of the calibration report
+report_columns = ['distribution', 'reads_per_gene', 'bin_size', 'tail_step',
+                  'max_reads', 'stop_probability', 'banded', 'genes',
+                  'reads_used',
+                  'map_bias', 'map_rmse', 'mean_bias', 'mean_rmse',
+                  'interval_coverage', 'seconds_per_gene']
+
+def simulate_genes(n_genes, tail_mean, tail_sd, reads_per_gene, f_size,
+                   f_prob, min_tail=1, max_tail=np.inf, start=1000000):
+    """Simulates reads for n_genes genes with a single 3'UTR ending at start
+       and tail lengths drawn from a normal distribution (rounded, clipped
+       to [min_tail, max_tail]). Returns the true tail lengths and reads per
+       gene."""
+    pAi = {'gene' : [{'start' : start, 'end' : 0, 'strand' : '+',
+                      'is_tail' : True}]}
+    tail_lengths = np.clip(np.round(np.random.normal(tail_mean, tail_sd,
+                                                     n_genes)),
+                           min_tail, max_tail).astype(int)
+    reads = [simulate_reads(['gene'], pAi, f_size, f_prob, reads_per_gene,
+                            tail_length)[2]['gene']
+             for tail_length in tail_lengths]
+    return tail_lengths, reads
+
+def credible_interval(posterior, tail_range, confidence=.95):
+    """Central credible interval of a posterior over the tail range."""
+    cumulative = np.cumsum(posterior)
+    lower = tail_range[np.searchsorted(cumulative, (1 - confidence) / 2)]
+    upper = tail_range[min(np.searchsorted(cumulative, (1 + confidence) / 2),
+                           len(tail_range) - 1)]
+    return lower, upper
+
+def calibrate(size, intensity, distributions, coverages, settings,
+              n_genes=1000, min_tail=10, max_tail=250, confidence=.95):
+    """Runs the calibration (see above) for all combinations of true tail
+       length distributions ((mean, sd) tuples), coverages (reads per gene)
+       and settings on the bioanalyzer profile (size, intensity). True tail
+       lengths are clipped to [min_tail, max_tail], tail length grids start
+       at min_tail and reach at least max_tail. Returns one report row
+       (dictionary with keys report_columns) per combination."""
+    f_true, prob_true = discretize_bioanalyzer_profile(size, intensity, 1)
+    profiles = {}
+    report = []
+    start = 1000000
+    genes = ['gene%i' % gene for gene in range(n_genes)]
+    pAi = [{'start' : start, 'end' : 0, 'strand' : '+', 'is_tail' : True}]
+    pAi_full = dict((gene, pAi) for gene in genes)
+    for tail_mean, tail_sd in distributions:
+        for reads_per_gene in coverages:
+            tail_lengths, reads = simulate_genes(n_genes, tail_mean, tail_sd,
+                                                 reads_per_gene, f_true,
+                                                 prob_true, min_tail,
+                                                 max_tail, start)
+            reads_by_gene = [(gene, [[read] for read in gene_reads])
+                             for gene, gene_reads in zip(genes, reads)]
+            for setting in settings:
+                bin_size = setting['bin_size']
+                if bin_size not in profiles:
+                    profiles[bin_size] = discretize_bioanalyzer_profile(
+                        size, intensity, bin_size)
+                f, prob_f = profiles[bin_size]
+                tail_range = tail_length_range(min_tail,
+                                               max_tail + setting['tail_step'],
+                                               setting['tail_step'])
+                banded = bool(setting.get('banded'))
+                # Build the likelihood table outside the timing
+                if banded:
+                    banded_likelihood_table(tail_range, f, prob_f)
+                else:
+                    likelihood_table(tail_range, f, prob_f)
+                start_time = time.time()
+                estimates = list(estimate_tail_lengths_streaming(
+                    reads_by_gene, genes, pAi_full, tail_range, f, prob_f,
+                    min_reads=0, collapse_duplicates=False, banded=banded,
+                    max_reads=setting.get('max_reads'),
+                    stop_probability=setting.get('stop_probability')))
+                seconds = time.time() - start_time
+                maps = []
+                means = []
+                covered = []
+                for (gene, used, posterior), tail_length in zip(estimates,
+                                                                tail_lengths):
+                    maps.append(tail_range[np.argmax(posterior)])
+                    means.append(np.dot(posterior, tail_range))
+                    lower, upper = credible_interval(posterior, tail_range,
+                                                     confidence)
+                    # Half a grid step of slack for tail lengths between
+                    # grid points
+                    covered.append(lower - setting['tail_step'] / 2
+                                   <= tail_length
+                                   <= upper + setting['tail_step'] / 2)
+                map_errors = np.array(maps) - tail_lengths
+                mean_errors = np.array(means) - tail_lengths
+                report.append({'distribution' : 'normal(%g,%g)'
+                                                % (tail_mean, tail_sd),
+                               'reads_per_gene' : reads_per_gene,
+                               'bin_size' : bin_size,
+                               'tail_step' : setting['tail_step'],
+                               'max_reads' : setting.get('max_reads'),
+                               'stop_probability' :
+                                   setting.get('stop_probability'),
+                               'banded' : banded,
+                               'genes' : n_genes,
+                               'reads_used' : float(np.mean(
+                                   [len(used) for gene, used, posterior
+                                    in estimates])),
+                               'map_bias' : float(np.mean(map_errors)),
+                               'map_rmse' : float(np.sqrt(np.mean(
+                                   map_errors ** 2))),
+                               'mean_bias' : float(np.mean(mean_errors)),
+                               'mean_rmse' : float(np.sqrt(np.mean(
+                                   mean_errors ** 2))),
+                               'interval_coverage' : float(np.mean(covered)),
+                               'seconds_per_gene' : seconds / n_genes})
+    return report
+
+def write_report(report, output):
+    """Writes calibration report rows as tab separated table."""
+    output.write('\t'.join(report_columns) + '\n')
+    for row in report:
+        output.write('\t'.join(str(row[column]) for column in report_columns)
+                     + '\n')
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+
+
+#########
+# about #
+#########
+
+__version__ = "0.1.0"
+__author__ = ["Nikolaos Karaiskos","Marcel Schilling"]
+__credits__ = ["Nikolaos Karaiskos","Mireya Plass Pórtulas","Marcel Schilling","Nikolaus Rajewsky"]
+__status__ = "beta"
+__licence__ = "GPL"
+__email__ = "marcel.schilling@mdc-berlin.de"
+
+
+###########
+# imports #
+###########
+
+import numpy as np
+from estimate_length import likelihood_table
+
+
+#############
+# functions #
+#############
+
+# Tests per gene whether the polyA tail length differs between two
+# conditions with several samples (libraries) each. Each sample is reduced
+# to a histogram of read offsets to the tail interval start, which turns
+# its log-likelihood over the tail range into a single product with the
+# log of the likelihood table. The test statistic is the log-likelihood
+# ratio of fitting one tail length per condition versus one for all
+# samples (both marginalized over a homogeneous prior on the tail range).
+# Its null distribution is obtained by permuting the condition labels of
+# the samples, evaluating all permutations as one matrix product.
+
+def offset_histograms(reads_per_sample, start, min_offset, n_offsets):
+    """Counts the reads of each sample per offset start - read, indexed
+       like the rows of the likelihood table. Reads outside the table
+       cannot be explained by any tail length and are ignored."""
+    histograms = np.zeros((len(reads_per_sample), n_offsets))
+    for sample, reads in enumerate(reads_per_sample):
+        rows = int(start) - np.asarray(reads, dtype=int) - min_offset
+        rows = rows[(rows >= 0) & (rows < n_offsets)]
+        histograms[sample] = np.bincount(rows, minlength=n_offsets)
+    return histograms
+
+def sample_log_likelihoods(histograms, log_table, zero_table):
+    """Log-likelihoods (samples x L) of the offset histograms."""
+    log_likelihoods = np.dot(histograms, log_table)
+    log_likelihoods[np.dot(histograms > 0, zero_table)] = -np.inf
+    return log_likelihoods
+
+def log_sum_exp(values, axis):
+    """Numerically stable log(sum(exp(values))) along axis."""
+    maximum = np.max(values, axis=axis, keepdims=True)
+    maximum = np.where(np.isfinite(maximum), maximum, 0)
+    return np.squeeze(maximum, axis=axis) + np.log(np.sum(np.exp(values
+                                                                 - maximum),
+                                                          axis=axis))
+
+def group_log_likelihood_ratios(log_likelihoods, assignments):
+    """Log-likelihood ratios of per group versus pooled tail lengths for a
+       batch of assignments (assignments x groups x samples one-hot) of the
+       samples (log_likelihoods: samples x L) to groups."""
+    pooled = log_sum_exp(log_likelihoods.sum(axis=0), axis=0)
+    grouped = np.einsum('pgs,sl->pgl', assignments,
+                        np.where(np.isfinite(log_likelihoods),
+                                 log_likelihoods, 0))
+    impossible = np.einsum('pgs,sl->pgl', assignments,
+                           (~np.isfinite(log_likelihoods)).astype(float)) > 0
+    grouped[impossible] = -np.inf
+    return log_sum_exp(grouped, axis=2).sum(axis=1) - pooled
+
+def benjamini_hochberg(p_values):
+    """Adjusts p-values for multiple testing (false discovery rate).
+       NaN p-values are ignored and stay NaN."""
+    p_values = np.asarray(p_values, dtype=float)
+    adjusted = np.full(len(p_values), np.nan)
+    tested = np.flatnonzero(~np.isnan(p_values))
+    order = tested[np.argsort(p_values[tested])]
+    ranked = p_values[order] * len(order) / np.arange(1, len(order) + 1)
+    adjusted[order] = np.minimum(1, np.minimum.accumulate(ranked[::-1])[::-1])
+    return adjusted
+
+def differential_tail_length(reads_per_sample, starts, conditions,
+                             tail_range, f, prob_f, permutations=1000,
+                             cache_dir=None):
+    """Tests each gene for a difference in polyA tail length between two
+       conditions. reads_per_sample is a list of {gene : read coordinates}
+       dictionaries, one per sample, conditions the list of their condition
+       labels and starts maps genes to the start of their tail interval
+       (e.g. pAi_full[gene][0]['start']). Returns {gene : (effect size,
+       statistic, p-value, adjusted p-value)}, the effect size being the
+       difference of the posterior mean tail lengths of the second and
+       first condition (in sorted order)."""
+    labels = sorted(set(conditions))
+    if len(labels) != 2:
+        raise ValueError('exactly two conditions required, got %i'
+                         % len(labels))
+    samples = np.array([labels.index(condition) for condition in conditions])
+    tail_range = np.asarray(tail_range)
+    min_offset, table = likelihood_table(tail_range, f, prob_f, cache_dir)
+    zero_table = table == 0
+    log_table = np.log(np.where(zero_table, 1, table))
+
+    # Observed assignment first, then label permutations shared by all
+    # genes
+    labelings = [samples] + [np.random.permutation(samples)
+                             for permutation in range(permutations)]
+    assignments = np.array([[labeling == group for group in range(2)]
+                            for labeling in labelings], dtype=float)
+
+    genes = sorted(set(gene for sample in reads_per_sample for gene in sample))
+    results = {}
+    for gene in genes:
+        histograms = offset_histograms([sample.get(gene, [])
+                                        for sample in reads_per_sample],
+                                       starts[gene], min_offset, len(table))
+        log_likelihoods = sample_log_likelihoods(histograms, log_table,
+                                                 zero_table)
+        ratios = group_log_likelihood_ratios(log_likelihoods, assignments)
+        means = []
+        for group in range(2):
+            posterior = log_likelihoods[samples == group].sum(axis=0)
+            posterior = np.exp(posterior - log_sum_exp(posterior, axis=0))
+            means.append(np.dot(posterior, tail_range))
+        if np.isfinite(ratios[0]):
+            # Tolerate rounding when permutations reproduce the observation
+            p_value = ((1 + np.sum(ratios[1:] >= ratios[0] - 1e-9))
+                       / (1 + permutations))
+        else:
+            p_value = np.nan
+        results[gene] = (means[1] - means[0], ratios[0], p_value)
+    adjusted = benjamini_hochberg([results[gene][2] for gene in genes])
+    return dict((gene, tuple(float(value) for value in results[gene])
+                 + (float(adjusted[index]),))
+                for index, gene in enumerate(genes))
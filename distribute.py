@@ -0,0 +1,339 @@
+#!/usr/bin/env python3
+
+
+#########
+# about #
+#########
+
+__version__ = "0.1.0"
+__author__ = ["Nikolaos Karaiskos","Marcel Schilling"]
+__credits__ = ["Nikolaos Karaiskos","Mireya Plass Pórtulas","Marcel Schilling","Nikolaus Rajewsky"]
+__status__ = "beta"
+__licence__ = "GPL"
+__email__ = "marcel.schilling@mdc-berlin.de"
+
+
+###########
+# imports #
+###########
+
+import os
+import gzip
+import json
+import itertools
+import time
+import socket
+import numpy as np
+from estimate_length import (merge_pAi_and_utr_intervals, utr_gene_spans,
+                             read_bioanalyzer_profile,
+                             discretize_bioanalyzer_profile,
+                             tail_length_range, read_bamfile_by_gene,
+                             read_coordinates_by_gene, read_lines,
+                             estimate_tail_lengths_streaming,
+                             write_atomically)
+
+
+#############
+# functions #
+#############
+
+# A work queue is a directory on a filesystem shared by all workers:
+#   manifest.tsv:                one line per chunk: chunk name and its
+#                                genes
+#   settings.json:               inputs and parameters of the estimation
+#   leases/<chunk>.<attempt>:    claim of a chunk by a worker (holding the
+#                                worker name), created exclusively; its
+#                                modification time is renewed while the
+#                                worker makes progress
+#   results/<chunk>.npz:         estimates of a finished chunk
+#   reads/<chunk>.txt.gz:        reads of the genes of a chunk (text input
+#                                only), split off when the queue is created
+# Workers claim the first chunk without result whose latest lease expired
+# (was not renewed for lease_seconds) or that has no lease, by creating the
+# lease of the next attempt. Only one worker can create it, and leases are
+# never renamed or removed before the result exists, so there is no gap
+# for a second worker to claim the same attempt. Chunks are attempted at
+# most max_attempts times. Results are written to a temporary file and
+# renamed, so a chunk computed twice after a lease was taken over from a
+# slow worker is harmless. No process needs to run besides the workers.
+# Workers read the reads of their chunk only (BAM files need an index), so
+# none of them holds or scans the whole input before renewing its lease.
+
+def create_queue(queue, genes, chunk_size, settings):
+    """Writes a work queue splitting genes into chunks of chunk_size genes.
+       settings is a dictionary with the keys utr, pai (BED files),
+       bioanalyzer, bin_size, tail_range ((start, end, step)), reads (file
+       name), format ('bam', 'bamfile' or 'coordinates', see the estimate
+       command of polyA.py), min_reads, joint, banded, cache_dir, max_reads
+       and stop_probability (see estimate_tail_lengths_streaming). Raises a
+       ValueError if queue is a non-empty directory, whose results would
+       be taken for those of the new queue, or if a BAM file is not
+       indexed. Text reads are split by chunk (see split_reads)."""
+    if os.path.isdir(queue) and os.listdir(queue):
+        raise ValueError('%s is not empty, refusing to create a work queue '
+                         'there' % queue)
+    if (settings['format'] == 'bam'
+            and not os.path.isfile(settings['reads'] + '.bai')):
+        raise ValueError('%s.bai is missing, BAM files of work queues need '
+                         'to be indexed' % settings['reads'])
+    os.makedirs(os.path.join(queue, 'leases'))
+    os.makedirs(os.path.join(queue, 'results'))
+    with open(os.path.join(queue, 'settings.json'), 'w') as f:
+        json.dump(settings, f, indent=1, sort_keys=True)
+    chunks = [('chunk%06i' % chunk, list(genes[first:(first + chunk_size)]))
+              for chunk, first in enumerate(range(0, len(genes),
+                                                  chunk_size))]
+    with open(os.path.join(queue, 'manifest.tsv'), 'w') as f:
+        for chunk, chunk_genes in chunks:
+            f.write('\t'.join([chunk] + chunk_genes) + '\n')
+    if settings['format'] != 'bam':
+        os.makedirs(os.path.join(queue, 'reads'))
+        split_reads(queue, chunks, settings['reads'], settings['format'])
+
+def reads_file(queue, chunk):
+    return os.path.join(queue, 'reads', chunk + '.txt.gz')
+
+def split_reads(queue, chunks, reads, format):
+    """Appends the lines of the text file reads ('bamfile' or 'coordinates'
+       format, grouped by gene) to the reads file of the chunk of their
+       gene, dropping genes of no chunk. Raises a ValueError if the reads
+       of a gene are not grouped together."""
+    chunk_of = dict((gene, chunk) for chunk, genes in chunks
+                    for gene in genes)
+    if format == 'bamfile':
+        gene_of = lambda line: line.split()[12][8:]
+    else:
+        gene_of = lambda line: line.split(',', 1)[0]
+    seen = set()
+    current = None
+    out = None
+    try:
+        for gene, lines in itertools.groupby(read_lines(reads), key=gene_of):
+            if gene in seen:
+                raise ValueError('reads of gene %s are not grouped together '
+                                 'in %s' % (gene, reads))
+            seen.add(gene)
+            if gene not in chunk_of:
+                continue
+            if chunk_of[gene] != current:
+                # Genes of a chunk are usually consecutive, reopening a
+                # chunk appends another gzip member
+                if out is not None:
+                    out.close()
+                current = chunk_of[gene]
+                out = gzip.open(reads_file(queue, current), 'at',
+                                compresslevel=1)
+            for line in lines:
+                out.write(line if line.endswith('\n') else line + '\n')
+    finally:
+        if out is not None:
+            out.close()
+
+def read_manifest(queue):
+    """Returns the (chunk, genes) tuples of a work queue."""
+    with open(os.path.join(queue, 'manifest.tsv'), 'r') as f:
+        return [(fields[0], fields[1:]) for fields in
+                (line.rstrip('\n').split('\t') for line in f)]
+
+def result_file(queue, chunk):
+    return os.path.join(queue, 'results', chunk + '.npz')
+
+def lease_file(queue, chunk, attempt):
+    return os.path.join(queue, 'leases', '%s.%i' % (chunk, attempt))
+
+def latest_attempts(queue):
+    """Returns the number of the latest attempt of each leased chunk."""
+    attempts = {}
+    for name in os.listdir(os.path.join(queue, 'leases')):
+        chunk, attempt = name.rsplit('.', 1)
+        attempts[chunk] = max(attempts.get(chunk, 0), int(attempt))
+    return attempts
+
+def create_lease(queue, chunk, worker, attempt):
+    """Creates the lease of an attempt of a chunk unless it exists. Returns
+       whether it was created."""
+    try:
+        fd = os.open(lease_file(queue, chunk, attempt),
+                     os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return False
+    with os.fdopen(fd, 'w') as f:
+        f.write(worker + '\n')
+    return True
+
+def lease_expired(queue, chunk, attempt, lease_seconds):
+    try:
+        return (time.time() - os.path.getmtime(lease_file(queue, chunk,
+                                                          attempt))
+                >= lease_seconds)
+    except FileNotFoundError:
+        # Released, i.e. finished
+        return False
+
+def claim_chunk(queue, worker, lease_seconds=600, max_attempts=3):
+    """Claims the first unfinished chunk that is not leased or whose latest
+       lease expired. Returns the chunk, its genes and the attempt number,
+       or None if there is none."""
+    attempts = latest_attempts(queue)
+    for chunk, genes in read_manifest(queue):
+        if os.path.isfile(result_file(queue, chunk)):
+            continue
+        attempt = attempts.get(chunk, 0)
+        if attempt > 0 and (attempt >= max_attempts
+                            or not lease_expired(queue, chunk, attempt,
+                                                 lease_seconds)):
+            continue
+        if create_lease(queue, chunk, worker, attempt + 1):
+            return chunk, genes, attempt + 1
+    return None
+
+def renew_lease(queue, chunk, attempt):
+    """Marks the lease of an attempt of a chunk as alive."""
+    try:
+        os.utime(lease_file(queue, chunk, attempt))
+    except FileNotFoundError:
+        pass
+
+def release_leases(queue, chunk):
+    """Removes all leases of a finished chunk."""
+    for attempt in range(1, latest_attempts(queue).get(chunk, 0) + 1):
+        try:
+            os.remove(lease_file(queue, chunk, attempt))
+        except FileNotFoundError:
+            pass
+
+def write_chunk_result(queue, chunk, estimates, n_tail_lengths):
+    """Writes the (gene, reads, probabilities) estimates of a chunk (see
+       estimate_tail_lengths_streaming) as arrays: genes, number of reads,
+       tail length probabilities (genes x L) and, for joint estimates, the
+       interval weights of all genes concatenated with their number per
+       gene."""
+    genes = []
+    n_reads = []
+    probs = []
+    weights = []
+    n_weights = []
+    for gene, reads, gene_probs in estimates:
+        if gene_probs is None:
+            continue
+        if isinstance(gene_probs, tuple):
+            weights.extend(gene_probs[0])
+            n_weights.append(len(gene_probs[0]))
+            gene_probs = gene_probs[1]
+        genes.append(gene)
+        n_reads.append(len(reads))
+        probs.append(gene_probs)
+    write_atomically(result_file(queue, chunk), lambda f: np.savez(
+        f, genes=np.array(genes, dtype=str),
+        n_reads=np.array(n_reads, dtype=np.int64),
+        probs=np.array(probs, dtype=float).reshape(len(genes),
+                                                  n_tail_lengths),
+        weights=np.array(weights, dtype=float),
+        n_weights=np.array(n_weights, dtype=np.int64)))
+
+def read_chunk_result(queue, chunk):
+    with np.load(result_file(queue, chunk)) as result:
+        return dict(result)
+
+def load_inputs(settings):
+    """Reads the inputs shared by all chunks: profile, intervals and tail
+       range."""
+    size, intensity = read_bioanalyzer_profile(settings['bioanalyzer'])
+    f_size, f_prob = discretize_bioanalyzer_profile(size, intensity,
+                                                    settings['bin_size'])
+    return {'f_size' : f_size, 'f_prob' : f_prob,
+            'pAi_full' : merge_pAi_and_utr_intervals(settings['utr'],
+                                                     settings['pai']),
+            'tail_range' : tail_length_range(*settings['tail_range'])}
+
+def chunk_reads(queue, chunk, settings, genes):
+    """Yields (gene, reads) tuples for the genes of a chunk. BAM files are
+       read at the 3'UTRs of the chunk only, text files from the reads of
+       the chunk split off by create_queue."""
+    if settings['format'] == 'bam':
+        from bam import read_bam_by_gene
+        genes = set(genes)
+        with open(settings['utr'], 'r') as f:
+            spans = utr_gene_spans(line for line in f
+                                   if line.split('\t')[3] in genes)
+        return read_bam_by_gene(settings['reads'], spans)
+    if not os.path.isfile(reads_file(queue, chunk)):
+        # No reads of any gene of the chunk
+        return iter([])
+    if settings['format'] == 'bamfile':
+        return read_bamfile_by_gene(reads_file(queue, chunk))
+    return read_coordinates_by_gene(reads_file(queue, chunk))
+
+def renewing(reads_by_gene, alive):
+    """Yields the (gene, reads) tuples of reads_by_gene, calling alive
+       after every gene read (of the chunk or not)."""
+    for gene_reads in reads_by_gene:
+        alive()
+        yield gene_reads
+
+def estimate_chunk(queue, chunk, settings, inputs, genes, alive=None):
+    """Estimates the tail lengths of the genes of a chunk, calling alive
+       (if given) after every gene read and every gene estimated."""
+    reads_by_gene = chunk_reads(queue, chunk, settings, genes)
+    if alive is not None:
+        reads_by_gene = renewing(reads_by_gene, alive)
+    for estimate in estimate_tail_lengths_streaming(
+            reads_by_gene, genes, inputs['pAi_full'],
+            inputs['tail_range'], inputs['f_size'], inputs['f_prob'],
+            min_reads=settings['min_reads'], joint=settings['joint'],
+            cache_dir=settings['cache_dir'],
+            collapse_duplicates=settings['format'] != 'coordinates',
+            banded=settings['banded'], max_reads=settings['max_reads'],
+            stop_probability=settings['stop_probability']):
+        if alive is not None:
+            alive()
+        yield estimate
+
+def run_worker(queue, worker=None, lease_seconds=600, max_attempts=3):
+    """Claims and estimates chunks until none is left. Returns the names
+       of the chunks finished by this worker."""
+    if worker is None:
+        worker = '%s:%i' % (socket.gethostname(), os.getpid())
+    with open(os.path.join(queue, 'settings.json'), 'r') as f:
+        settings = json.load(f)
+    inputs = None
+    finished = []
+    while True:
+        claimed = claim_chunk(queue, worker, lease_seconds, max_attempts)
+        if claimed is None:
+            return finished
+        chunk, genes, attempt = claimed
+        if inputs is None:
+            inputs = load_inputs(settings)
+        alive = lambda: renew_lease(queue, chunk, attempt)
+        write_chunk_result(queue, chunk,
+                           estimate_chunk(queue, chunk, settings, inputs,
+                                          genes, alive),
+                           len(inputs['tail_range']))
+        release_leases(queue, chunk)
+        finished.append(chunk)
+
+def missing_chunks(queue):
+    """Names of the chunks without result."""
+    return [chunk for chunk, genes in read_manifest(queue)
+            if not os.path.isfile(result_file(queue, chunk))]
+
+def merge_results(queue, tail_lengths, usage=None):
+    """Writes the estimates of all chunks (in manifest order) to the open
+       files tail_lengths and (for joint estimates) usage in the format of
+       tail_lengths.txt and pAi_usage.txt written by pipeline.py. Raises a
+       ValueError if chunks are unfinished."""
+    missing = missing_chunks(queue)
+    if missing:
+        raise ValueError('%i chunks of %s are unfinished: %s'
+                         % (len(missing), queue, ', '.join(missing)))
+    for chunk, genes in read_manifest(queue):
+        result = read_chunk_result(queue, chunk)
+        first_weights = np.concatenate([[0], np.cumsum(result['n_weights'])])
+        for index, gene in enumerate(result['genes']):
+            tail_lengths.write(gene + ',' + str(result['probs'][index].tolist())
+                               + '\n')
+            if usage is not None and len(result['n_weights']) > 0:
+                usage.write(gene + ',' + str(result['weights'][
+                    first_weights[index]:first_weights[index + 1]].tolist())
+                            + '\n')
@@ -0,0 +1,429 @@
+#!/usr/bin/env python3
+
+
+#########
+# about #
+#########
+
+__version__ = "0.1.0"
+__author__ = ["Nikolaos Karaiskos","Marcel Schilling"]
+__credits__ = ["Nikolaos Karaiskos","Mireya Plass Pórtulas","Marcel Schilling","Nikolaus Rajewsky"]
+__status__ = "beta"
+__licence__ = "GPL"
+__email__ = "marcel.schilling@mdc-berlin.de"
+
+
+# Checks every fast implementation against the reference function it
+# replaces (prob_d_given_L, prob_d_given_pAi, estimate_poly_tail_length,
+# extract_pAi_from_genome and annotate_pAi_with_gene) on small randomized
+# inputs and runs each fast implementation once on a larger input that
+# has to finish within the time budget of its stage. All inputs are
+# generated here, so this runs offline in a few seconds.
+
+
+################################
+# seed random number generator #
+################################
+
+# see unit_test.py
+import numpy as np
+np.random.seed(42)
+
+
+###########
+# imports #
+###########
+
+import unittest
+import os
+import sys
+import time
+import tempfile
+from estimate_length import *
+from genome import pack_genome, scan_pAi_parameters
+
+
+##############
+# parameters #
+##############
+
+# Tolerances for comparing probabilities of fast and reference paths
+rtol = 1e-9
+atol = 1e-12
+
+# Random inputs compared against the reference functions per test
+repetitions = 5
+
+# Maximal runtime (seconds) of each fast path on the inputs of its
+# performance test, with a wide margin for slow test machines
+time_budgets = {'interval_kernel' : 2,
+                'offset_kernel' : 2,
+                'estimate_tail_lengths_streaming' : 5,
+                'estimate_pAi_usage_and_tail_length_banded' : 10,
+                'scan_pAi' : 5,
+                'scan_pAi_parameters' : 2,
+                'annotate_pAi' : 2}
+
+
+#############
+# functions #
+#############
+
+def random_profile(max_size=600):
+    """Random bioanalyzer profile (sorted fragment sizes with
+       probabilities) as returned by discretize_bioanalyzer_profile."""
+    f = np.unique(np.random.randint(50, max_size, np.random.randint(20, 80)))
+    prob_f = np.random.random(len(f))
+    return f, prob_f / prob_f.sum()
+
+def random_tail_range():
+    """Random grid of tail lengths."""
+    start = np.random.randint(1, 30)
+    return tail_length_range(start, start + np.random.randint(50, 200),
+                             np.random.randint(5, 30))
+
+def random_reads(start, n_reads, f, tail_range):
+    """Random read coordinates around an interval start, including reads
+       too far away to be explained by any tail length."""
+    return list(start - np.random.randint(-max(tail_range) - 10, max(f) + 10,
+                                          n_reads))
+
+def random_genome(chromosomes, length, window):
+    """Random FASTA lines rich in A and T stretches. Each chromosome starts
+       with a pAi at coordinate 0, which keeps extract_pAi_from_genome from
+       merging intervals across chromosomes."""
+    bases = ['A', 'C', 'G', 'T', 'a', 'N', 'AAAAAAA', 'TTTTTT', 'AATAAA',
+             'TTATTT']
+    genome = []
+    for chromosome in chromosomes:
+        sequence = window * 'A' + ''.join(np.random.choice(bases, length))
+        width = np.random.randint(30, 90)
+        genome.append('>%s dna:chromosome\n' % chromosome)
+        genome += [sequence[i:(i + width)] + '\n'
+                   for i in range(0, len(sequence), width)]
+    return genome
+
+def random_annotation(n_genes, chromosome='9'):
+    """Random GTF lines of n_genes genes (one to three transcripts each,
+       the last exon holding the 3'UTR) on one chromosome and random pAi
+       BED lines around them. Genes follow each other with large gaps,
+       coordinates have six digits and every gap holds a pAi belonging to
+       no gene, as assumed by annotate_pAi_with_gene. The last gene holds
+       no pAi since annotate_pAi_with_gene never annotates it."""
+    gtf = ['#!genome-build random\n']
+    pAi = []
+    position = 100000
+    for gene in range(n_genes + 1):
+        name = 'gene%i' % gene
+        strand = np.random.choice(['+', '-'])
+        attributes = 'gene_id "G%i"; gene_name "%s";' % (gene, name)
+        length = np.random.randint(500, 5000)
+        gtf.append('\t'.join([chromosome, 'random', 'gene', str(position + 1),
+                              str(position + length), '.', strand, '.',
+                              attributes]) + '\n')
+        for transcript in range(np.random.randint(1, 4)):
+            first_end = position + np.random.randint(100, length // 2)
+            last_start = first_end + np.random.randint(50, 200)
+            last_end = np.random.randint(last_start + 20, position + length + 1)
+            exons = [(position, first_end), (last_start, last_end)]
+            if strand == '-':
+                exons.reverse()
+            utr_length = np.random.randint(1, exons[1][1] - exons[1][0])
+            if strand == '+':
+                utr = (exons[1][1] - utr_length, exons[1][1])
+            else:
+                utr = (exons[1][0], exons[1][0] + utr_length)
+            for feature, (start, end) in [('transcript', (position,
+                                                          position + length))
+                                          ] + [('exon', exon)
+                                               for exon in exons] + [
+                                              ('three_prime_utr', utr)]:
+                gtf.append('\t'.join([chromosome, 'random', feature,
+                                      str(start + 1), str(end), '.', strand,
+                                      '.', attributes]) + '\n')
+        if gene < n_genes:
+            for interval in range(np.random.randint(0, 10)):
+                start = position + np.random.randint(-30, length + 30)
+                pAi.append((start, start + np.random.randint(5, 20),
+                            np.random.choice(['+', '-'])))
+            pAi.append((position + length + 500, position + length + 510,
+                        '+'))
+        position += length + 1000
+    pAi.sort()
+    return gtf, ['%s\t%i\t%i\t.\t%s\n' % (chromosome, start, end, strand)
+                 for start, end, strand in pAi]
+
+def read_bed(filename):
+    """Reads the fields of a BED file as tuples, converting coordinates to
+       integers and ignoring the name column of unannotated pAi."""
+    with open(filename, 'r') as f:
+        rows = [line.rstrip('\n').split('\t') for line in f]
+    return [tuple([chr, int(start), int(end)]
+                  + [field.strip() for field in fields if field != '.'])
+            for chr, start, end, *fields in rows]
+
+def in_folder(folder, function, *args):
+    """Calls function in folder (for reference functions writing to the
+       working directory)."""
+    cwd = os.getcwd()
+    os.chdir(folder)
+    try:
+        return function(*args)
+    finally:
+        os.chdir(cwd)
+
+def elapsed(function, *args):
+    """Runtime of function(*args) in seconds (consuming generators)."""
+    start_time = time.time()
+    result = function(*args)
+    if hasattr(result, '__next__'):
+        for item in result:
+            pass
+    return time.time() - start_time
+
+
+#########
+# tests #
+#########
+
+class TestFastPathsMatchReference(unittest.TestCase):
+
+    def assertWithinBudget(self, stage, function, *args):
+        seconds = elapsed(function, *args)
+        self.assertLess(seconds, time_budgets[stage],
+                        '%s took %.2f s (budget: %g s)'
+                        % (stage, seconds, time_budgets[stage]))
+
+    def test_interval_kernel_matches_prob_d_given_L(self):
+        for repetition in range(repetitions):
+            f, prob_f = random_profile()
+            tail_range = random_tail_range()
+            pAi = [{'start' : 5000, 'end' : 0, 'strand' : '+',
+                    'is_tail' : True}]
+            reads = random_reads(5000, 20, f, tail_range)
+            kernel = interval_kernel(reads, pAi, tail_range, f, prob_f)[:, 0]
+            for read, read_kernel in zip(reads, kernel):
+                with np.errstate(invalid='ignore'):
+                    reference = [prob_d_given_L(read, pAi, 0, length, f,
+                                                prob_f, tail_range)
+                                 for length in tail_range]
+                if read_kernel.sum() == 0:
+                    # Reads unexplained by any tail length
+                    self.assertTrue(np.all(np.isnan(reference)))
+                    continue
+                self.assertTrue(np.allclose(read_kernel / read_kernel.sum(),
+                                            reference, rtol=rtol, atol=atol))
+
+    def test_interval_kernel_matches_prob_d_given_pAi(self):
+        for repetition in range(repetitions):
+            f, prob_f = random_profile()
+            starts = np.sort(np.random.randint(1000, 3000, 4))
+            pAi = [{'start' : start, 'end' : start + np.random.randint(5, 50),
+                    'strand' : '+', 'is_tail' : False} for start in starts]
+            reads = random_reads(3000, 20, f, [0])
+            kernel = interval_kernel(reads, pAi, [1], f, prob_f)[:, :, 0]
+            for read, read_kernel in zip(reads, kernel):
+                if read_kernel.sum() > 0:
+                    read_kernel = read_kernel / read_kernel.sum()
+                self.assertTrue(np.allclose(read_kernel,
+                                            [prob_d_given_pAi(read, pAi,
+                                                              interval, f,
+                                                              prob_f)
+                                             for interval in range(len(pAi))],
+                                            rtol=rtol, atol=atol))
+
+    def test_offset_kernel_matches_prob_d_given_L(self):
+        for repetition in range(repetitions):
+            f, prob_f = random_profile()
+            tail_range = random_tail_range()
+            pAi = [{'start' : 5000, 'end' : 0, 'strand' : '+',
+                    'is_tail' : True}]
+            reads = random_reads(5000, 20, f, tail_range)
+            kernel = offset_kernel(5000 - np.array(reads), tail_range, f,
+                                   prob_f)
+            for read, read_kernel in zip(reads, kernel):
+                with np.errstate(invalid='ignore'):
+                    reference = [prob_d_given_L(read, pAi, 0, length, f,
+                                                prob_f, tail_range)
+                                 for length in tail_range]
+                if read_kernel.sum() == 0:
+                    # Reads unexplained by any tail length
+                    self.assertTrue(np.all(np.isnan(reference)))
+                    continue
+                self.assertTrue(np.allclose(read_kernel / read_kernel.sum(),
+                                            reference, rtol=rtol, atol=atol))
+
+    def test_banded_likelihood_table_matches_prob_d_given_L(self):
+        for repetition in range(repetitions):
+            f, prob_f = random_profile()
+            tail_range = random_tail_range()
+            pAi = [{'start' : 5000, 'end' : 0, 'strand' : '+',
+                    'is_tail' : True}]
+            reads = random_reads(5000, 20, f, tail_range)
+            table = banded_likelihood_table(tail_range, f, prob_f)
+            rows = banded_rows(table, 5000 - np.array(reads))
+            kernel = np.array([banded_dot(table, rows, vector, tail_range)
+                               for vector in np.eye(len(tail_range))]).T
+            for read, read_kernel in zip(reads, kernel):
+                with np.errstate(invalid='ignore'):
+                    reference = [prob_d_given_L(read, pAi, 0, length, f,
+                                                prob_f, tail_range)
+                                 for length in tail_range]
+                if read_kernel.sum() == 0:
+                    # Reads unexplained by any tail length
+                    self.assertTrue(np.all(np.isnan(reference)))
+                    continue
+                self.assertTrue(np.allclose(read_kernel / read_kernel.sum(),
+                                            reference, rtol=rtol, atol=atol))
+
+    def test_streaming_estimation_matches_estimate_poly_tail_length(self):
+        f, prob_f = random_profile()
+        tail_range = random_tail_range()
+        pAi_full = {}
+        reads_by_gene = []
+        for gene in range(repetitions):
+            start = np.random.randint(1000, 10000)
+            pAi_full[gene] = [{'start' : str(start), 'end' : 0,
+                               'strand' : '+', 'is_tail' : True}]
+            # Reads in reach of the shortest fragment, which every tail
+            # length explains (the reference needs explained reads)
+            reads_by_gene.append((gene, [[str(start - min(f) + read), '+',
+                                          'UMI%i' % read]
+                                         for read in range(20)]))
+        for banded in [False, True]:
+            for gene, reads, probs in estimate_tail_lengths_streaming(
+                    reads_by_gene, list(pAi_full), pAi_full, tail_range, f,
+                    prob_f, min_reads=1, banded=banded):
+                self.assertTrue(np.allclose(probs, estimate_poly_tail_length(
+                                    reads, tail_range, pAi_full[gene], 0, f,
+                                    prob_f, False), rtol=rtol, atol=atol))
+
+    def test_scanners_match_extract_pAi_from_genome(self):
+        for repetition in range(repetitions):
+            window = np.random.randint(3, 15)
+            parameters = (window, np.random.randint(1, window + 1),
+                          np.random.randint(1, 10))
+            genome = random_genome(['9', '10', 'MT'], 300, window)
+            with tempfile.TemporaryDirectory() as folder:
+                with open(os.path.join(folder, 'genome.fa'), 'w') as f:
+                    f.writelines(genome)
+                in_folder(folder, extract_pAi_from_genome, 'genome.fa',
+                          *parameters)
+                reference = read_bed(os.path.join(folder, 'pAi.bed'))
+                pack_genome(os.path.join(folder, 'genome.fa'),
+                            os.path.join(folder, 'cache'))
+                sweep = scan_pAi_parameters(os.path.join(folder, 'cache'),
+                                            [parameters], 101)[parameters]
+            # extract_pAi_from_genome drops the last interval
+            self.assertEqual(list(scan_pAi(genome, *parameters))[:-1],
+                             reference)
+            self.assertEqual(sweep[:-1], reference)
+
+    def test_annotate_pAi_matches_annotate_pAi_with_gene(self):
+        for repetition in range(repetitions):
+            gtf, pAi_bed = random_annotation(20)
+            with tempfile.TemporaryDirectory() as folder:
+                with open(os.path.join(folder, 'genes.gtf'), 'w') as f:
+                    f.writelines(gtf)
+                with open(os.path.join(folder, 'pAi.bed'), 'w') as f:
+                    f.writelines(pAi_bed)
+                with open(os.path.join(folder, 'utr.bed'), 'w') as f:
+                    extract_three_prime_utr_information(
+                        os.path.join(folder, 'genes.gtf'),
+                        bed_name_attributes = ['gene_name'], output = f)
+                in_folder(folder, annotate_pAi_with_gene, 'pAi.bed',
+                          'utr.bed')
+                reference = read_bed(os.path.join(folder, 'pAi_gene.bed'))
+                with open(os.path.join(folder, 'utr.bed'), 'r') as f:
+                    spans = utr_gene_spans(f)
+            self.assertEqual(sorted(annotate_pAi(pAi_bed, spans)),
+                             sorted(reference))
+
+    def test_interval_kernel_within_time_budget(self):
+        f, prob_f = random_profile(1000)
+        pAi = [{'start' : start, 'end' : start + 20, 'strand' : '+',
+                'is_tail' : False} for start in range(10000, 15000, 1000)]
+        pAi.append({'start' : 16000, 'end' : 0, 'strand' : '+',
+                    'is_tail' : True})
+        self.assertWithinBudget('interval_kernel', interval_kernel,
+                                random_reads(16000, 100000, f, [500]), pAi,
+                                tail_length_range(1, 500, 5), f, prob_f)
+
+    def test_offset_kernel_within_time_budget(self):
+        f, prob_f = random_profile(1000)
+        tail_range = tail_length_range(1, 500, 1)
+        likelihood_tables.clear()
+        self.assertWithinBudget('offset_kernel', offset_kernel,
+                                np.random.randint(-500, 1000, 100000),
+                                tail_range, f, prob_f)
+
+    def test_estimate_tail_lengths_streaming_within_time_budget(self):
+        f, prob_f = random_profile(1000)
+        genes = ['gene%i' % gene for gene in range(300)]
+        pAi_full = dict((gene, [{'start' : '10000', 'end' : 0,
+                                 'strand' : '+', 'is_tail' : True}])
+                        for gene in genes)
+        reads_by_gene = [(gene, [[str(read), '+', 'UMI%i' % index]
+                                 for index, read
+                                 in enumerate(10000 - np.random.randint(
+                                     min(f), max(f), 300))])
+                         for gene in genes]
+        likelihood_tables.clear()
+        self.assertWithinBudget('estimate_tail_lengths_streaming',
+                                estimate_tail_lengths_streaming,
+                                reads_by_gene, genes, pAi_full,
+                                tail_length_range(10, 550, 5), f, prob_f)
+
+    def test_banded_joint_estimation_at_1nt_within_time_budget(self):
+        # Profile and tail length grid at 1 nt resolution
+        f = np.arange(50, 1000)
+        prob_f = np.random.random(len(f))
+        prob_f /= prob_f.sum()
+        pAi = [{'start' : start, 'end' : start + 20, 'strand' : '+',
+                'is_tail' : False} for start in [14000, 15000]]
+        pAi.append({'start' : 16000, 'end' : 0, 'strand' : '+',
+                    'is_tail' : True})
+        likelihood_tables.clear()
+        self.assertWithinBudget('estimate_pAi_usage_and_tail_length_banded',
+                                estimate_pAi_usage_and_tail_length_banded,
+                                random_reads(16000, 1000, f, [500]),
+                                tail_length_range(1, 500, 1), pAi, f, prob_f)
+
+    def test_scan_pAi_within_time_budget(self):
+        genome = random_genome(['9'], 100000, 10)
+        self.assertWithinBudget('scan_pAi', scan_pAi, genome, 10, 7, 6)
+
+    def test_scan_pAi_parameters_within_time_budget(self):
+        with tempfile.TemporaryDirectory() as folder:
+            with open(os.path.join(folder, 'genome.fa'), 'w') as f:
+                f.writelines(random_genome(['9', '10'], 200000, 12))
+            pack_genome(os.path.join(folder, 'genome.fa'),
+                        os.path.join(folder, 'cache'))
+            self.assertWithinBudget('scan_pAi_parameters',
+                                    scan_pAi_parameters,
+                                    os.path.join(folder, 'cache'),
+                                    [(10, 7, 6), (10, 8, 6), (12, 8, 7)])
+
+    def test_annotate_pAi_within_time_budget(self):
+        gtf, pAi_bed = random_annotation(2000)
+        with tempfile.TemporaryDirectory() as folder:
+            with open(os.path.join(folder, 'genes.gtf'), 'w') as f:
+                f.writelines(gtf)
+            with open(os.path.join(folder, 'utr.bed'), 'w') as f:
+                extract_three_prime_utr_information(
+                    os.path.join(folder, 'genes.gtf'),
+                    bed_name_attributes = ['gene_name'], output = f)
+            with open(os.path.join(folder, 'utr.bed'), 'r') as f:
+                spans = utr_gene_spans(f)
+        self.assertWithinBudget('annotate_pAi', annotate_pAi, pAi_bed * 10,
+                                spans)
+
+
+#######
+# run #
+#######
+
+suite = unittest.TestLoader().loadTestsFromTestCase(TestFastPathsMatchReference)
+
+# exit 0 only if all tests pass (see http://stackoverflow.com/a/24972157/2451238)
+sys.exit(not unittest.TextTestRunner(verbosity=2).run(suite).wasSuccessful())
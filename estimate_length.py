@@ -17,163 +17,29 @@ __email__ = "marcel.schilling@mdc-berlin.de"
 # imports #
 ###########
 
-import gzip
 import numpy as np
 from collections import defaultdict
 import time
 import decimal
-from scipy.interpolate import interp1d
+import itertools
+import hashlib
+import os
+import sys
+import tempfile
+# File reading and text-only stages, re-exported for existing callers
+from annotation import (is_gzip_file, open_file, gzip_magic, bgzf_blocks,
+                        inflate_bgzf_block, is_bgzf, read_raw_blocks,
+                        inflate_gzip_members, inflate_bgzf_parallel,
+                        read_blocks, read_lines, prefetch,
+                        extract_three_prime_utr_information, scan_pAi,
+                        scan_pAi_windows, utr_gene_spans, annotate_pAi,
+                        single_utr_genes, single_utr_no_pAi_genes)
 
 
 #############
 # functions #
 #############
 
-# Test if a file is gzip compressed or not
-def is_gzip_file(filename):
-    try:
-        # This will raise OSError for uncompressed files & has no side
-        # effects for compressed files:
-        gzip.GzipFile(filename).peek(1)
-        return True
-    except OSError:
-        return False
-
-# Open a file (gzip compressed or not)
-def open_file(filename):
-    if (is_gzip_file(filename)):
-        return gzip.open(filename,'rt')
-    else:
-        return open(filename,'rt')
-
-
-# Read annotation from GTF file
-# For now, this will output BED to STDOUT, but this might be changed to
-# either file output or returing the GTF data as a python object
-def extract_three_prime_utr_information(gtf_file,
-                                        bed_name_attributes = ["gene_id",
-                                                               "gene_name"],
-                                        bed_name_separator = "|",
-                                        feature_utr3 = "three_prime_utr",
-                                        feature_gene = "gene",
-                                        feature_transcript = "transcript",
-                                        feature_exon = "exon"):
-
-    # The following parameters define the parsing of the input GTF file.
-    # They were chosen according to the standard described in
-    # http://genome.ucsc.edu/FAQ/FAQformat.html#format4.
-
-    # Lines starting with the following character will be skipped:
-    comment_char = '#'
-
-    # Lines will be split into fields by the following character:
-    field_separator = '\t'
-
-    # The attributes field will be split into type/value pairs by the
-    # following string:
-    attributes_separator = "; "
-
-    # The attribute with the following index will be used as gene ID:
-    attribute_index_gene_id = 0
-
-    # Attribute type/value pairs will be split by the following
-    # character:
-    attribute_separator = ' "'
-
-    # The following index will be used to get the value of an attribute
-    # type/value pair:
-    attribute_value_index = 1
-
-    # The following character will be removed from the beginning and end
-    # of attribute values:
-    attribute_value_quote = '"'
-
-    # The following character will be used to separte fields in the BED
-    # output:
-    bed_separator = '\t'
-
-    # This set will be used to store all 3' UTR BED entries for the
-    # current gene.
-    three_prime_utrs = set()
-
-    # Read GTF input line by line
-    with open_file(gtf_file) as gtf:
-        for line in gtf:
-
-            # Skip comment lines
-            if (line[0] == comment_char):
-                continue
-
-            # Split lines into fields
-            (seqname, source, feature, start, end, score, strand, frame,
-                attributes) = line.rstrip().split(field_separator)
-
-            # Output BED line for each (different) 3' UTR isoform of the
-            # previous gene & re-initialize 3' UTR set for current gene
-            if (feature == feature_gene):
-                for three_prime_utr in three_prime_utrs:
-                    print(bed_separator.join(str(field) for field in
-                                             three_prime_utr))
-                three_prime_utrs = set()
-                continue
-
-            # Re-initialize extension length for new transcripts
-            if (feature == feature_transcript):
-                extension_length=0
-                continue
-
-            # Convert from 1-based closed to 0-based open intervals
-            start = (int(start) - 1)
-            end = int(end)
-
-            # Store coordinates of last exon of the current transcript
-            if (feature == feature_exon):
-                exon=dict(start = start, end = end)
-                continue
-
-            # Skip lines not defining 3' UTRs
-            if (feature != feature_utr3):
-                continue
-
-            # Split attributes into type/value pairs
-            attributes = attributes.split(attributes_separator)
-            attributes = [attribute.rstrip(attributes_separator) for attribute
-                          in attributes]
-            attributes = [attribute.split(attribute_separator) for attribute in
-                          attributes]
-            attributes = dict((key, value[:-1]) for (key, value) in attributes)
-
-            # Construct BED name field from specified GTF attributes
-            gene=bed_name_separator.join(attributes[attribute] for attribute in
-                                         bed_name_attributes)
-
-            # Count 3' UTR nucleotides in upstream exons
-            if (strand == "+" and exon["end"] != end) or \
-               (strand == "-" and exon["start"] != start):
-                extension_length -= end - start
-
-            # Determine number of extra nucleotides in last exon
-            # compared to 3' UTR only
-            else:
-                if (strand == "+"):
-                    extension_length += start - exon["start"]
-                else:
-                    extension_length += exon["end"] - end
-
-            # Append current 3' UTR to 3' UTRs of current gene (if not
-            # seen before) replacing the coordinates by those of the
-            # last exon and the score by the number of nucleotides added
-            # to the 3' UTR by this extension (negative for spliced 3'
-            # UTRs)
-            three_prime_utrs.add((seqname, exon["start"], exon["end"], gene,
-                                  strand, extension_length))
-
-    # Output BED line for each (different) 3' UTR isoform of the last
-    # gene
-    for three_prime_utr in three_prime_utrs:
-        print(bed_separator.join(str(field) for field in three_prime_utr))
-
-
 def merge_pAi_and_utr_intervals(utr_bed, pAi_bed):
     """Merges pAi intervals with 3'UTRs into a big dictionary, suitable
        for downstream analysis. Requires gene annotated pAi bed file."""
@@ -268,6 +134,16 @@ def annotate_pAi_with_gene(pAi_bed, utr_bed):
                     break
             cur_chr, cur_start, cur_end, cur_gene, cur_strand, cur_score = line.split('\t')
 
+def read_bioanalyzer_profile(bioanalyzer):
+    """Reads a bioanalyzer profile (fragment size and intensity per line)."""
+    size = []
+    intensity = []
+    with open_file(bioanalyzer) as f:
+        for line in f:
+            size.append(int(line.split()[0]))
+            intensity.append(float(line.split()[1]))
+    return np.array(size), np.array(intensity)
+
 ### Will be deprecated in the future. Interpolate from scipy performs much better.
 def discretize_bioanalyzer_profile_old(size, intensity, bin_size):
     """Discretizes a given bioanalyzer profile intensity=f(size) by putting 
@@ -279,6 +155,9 @@ def discretize_bioanalyzer_profile_old(size, intensity, bin_size):
     return np.unique(size), probability
 
 def discretize_bioanalyzer_profile(size, intensity, bin_size):
+    # Imported here to keep scipy out of the startup time of the command
+    # line interface for stages not needing it
+    from scipy.interpolate import interp1d
     f = interp1d(size, intensity)
     new_size = np.linspace(min(size), max(size), 
                            num=round(max(size-min(size))/bin_size))
@@ -363,6 +242,437 @@ def prob_d_given_L_weighted(read_coordinate, pAi, interval, Length, f, prob_f,
     return nominator/norm_factor
 
 
+def profile_mass_between(lower, upper, f, prob_f):
+    """Vectorized sum(prob_f * step_function(f - lower) * step_function(upper
+       - f)), i.e. the probability of a fragment size strictly between lower
+       and upper, for arrays of bounds. Requires f to be sorted."""
+    cumulative = np.concatenate([[0], np.cumsum(prob_f)])
+    first = np.searchsorted(f, lower, side='right')
+    last = np.searchsorted(f, upper, side='left')
+    return np.where(last > first, cumulative[last] - cumulative[first], 0)
+
+def interval_kernel(reads, pAi, tail_range, f, prob_f):
+    """Computes the reads x intervals x L array of likelihoods P(d|interval,
+       L) for all intervals of a gene. For tail intervals, these are the
+       nominators of prob_d_given_L, for internal priming intervals the
+       nominators of prob_d_given_pAi (independent of L)."""
+    reads = np.asarray(reads, dtype=int)[:, None]
+    tail_range = np.asarray(tail_range)
+    kernel = np.zeros((reads.shape[0], len(pAi), len(tail_range)))
+    for index, interval in enumerate(pAi):
+        start = int(interval['start'])
+        if interval['is_tail']:
+            kernel[:, index, :] = profile_mass_between(
+                start - reads - 1, start - reads + tail_range, f,
+                prob_f) / tail_range
+        else:
+            end = int(interval['end'])
+            kernel[:, index, :] = profile_mass_between(
+                start - reads, end - reads, f, prob_f) / (end - start)
+    return kernel
+
+def estimate_pAi_usage_and_tail_length(reads, tail_range, pAi, f, prob_f,
+                                       max_iterations=1000, tolerance=1e-10):
+    """Jointly estimates the usage weights of all intervals of a gene (3'UTR
+       isoforms and pAi) and the polyA tail length distribution over
+       tail_range by expectation maximization. Reads not explained by any
+       interval are ignored. Returns the weights (in the order of pAi) and
+       the tail length probabilities."""
+    reads, counts = np.unique(np.asarray(reads, dtype=int),
+                              return_counts=True)
+    kernel = interval_kernel(reads, pAi, tail_range, f, prob_f)
+    explained = kernel.sum(axis=(1, 2)) > 0
+    kernel = kernel[explained]
+    counts = counts[explained]
+    is_tail = np.array([bool(interval['is_tail']) for interval in pAi])
+    weights = np.full(len(pAi), 1 / len(pAi))
+    tail_probs = np.full(len(tail_range), 1 / len(tail_range))
+    log_likelihood = -np.inf
+    for iteration in range(max_iterations):
+        # E step: responsibilities of each (interval, L) for each read
+        joint = kernel * weights[None, :, None] * tail_probs[None, None, :]
+        read_probs = joint.sum(axis=(1, 2))
+        responsibilities = joint * (counts / read_probs)[:, None, None]
+
+        # M step: interval weights and tail length distribution
+        weights = responsibilities.sum(axis=(0, 2)) / counts.sum()
+        tail_counts = responsibilities[:, is_tail, :].sum(axis=(0, 1))
+        if tail_counts.sum() > 0:
+            tail_probs = tail_counts / tail_counts.sum()
+
+        previous_log_likelihood = log_likelihood
+        log_likelihood = np.dot(counts, np.log(read_probs))
+        if (log_likelihood - previous_log_likelihood
+                <= tolerance * abs(log_likelihood)):
+            break
+    return weights, tail_probs
+
+
+def write_atomically(filename, write):
+    """Calls write with a binary temporary file in the directory of
+       filename, then renames it to filename, so that other processes
+       (e.g. on a shared filesystem) never see a partially written file."""
+    fd, temporary = tempfile.mkstemp(dir=os.path.dirname(filename) or '.',
+                                     suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        os.replace(temporary, filename)
+    except BaseException:
+        os.remove(temporary)
+        raise
+
+# Likelihood tables computed in this process, by likelihood_table_key
+# (prefixed with 'banded_' for banded tables)
+likelihood_tables = {}
+
+def likelihood_table_key(tail_range, f, prob_f):
+    """Hashes the inputs a likelihood table depends on."""
+    key = hashlib.sha1()
+    for values in [tail_range, f, prob_f]:
+        key.update(np.ascontiguousarray(values, dtype=float).tobytes())
+        key.update(b'|')
+    return key.hexdigest()
+
+def likelihood_table(tail_range, f, prob_f, cache_dir=None):
+    """Returns the table of P(d|L) nominators (as in prob_d_given_L) for all
+       offsets o = pAi[interval]['start'] - d that can have a nonzero
+       likelihood, from min(f) - max(tail_range) + 1 to max(f), and all L in
+       tail_range. Returns the smallest offset and the table (offsets x L).
+       Tables are memoized per process and, if cache_dir is given, stored
+       there to be reused by other runs with the same profile."""
+    key = likelihood_table_key(tail_range, f, prob_f)
+    min_offset = int(min(f) - max(tail_range) + 1)
+    if key in likelihood_tables:
+        return min_offset, likelihood_tables[key]
+    if cache_dir is not None:
+        cache_file = os.path.join(cache_dir, 'likelihood_table_%s.npy' % key)
+        if os.path.isfile(cache_file):
+            likelihood_tables[key] = np.load(cache_file)
+            return min_offset, likelihood_tables[key]
+    offsets = np.arange(min_offset, int(max(f)) + 1)[:, None]
+    tail_range = np.asarray(tail_range)
+    table = profile_mass_between(offsets - 1, offsets + tail_range, f,
+                                 prob_f) / tail_range
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        write_atomically(cache_file, lambda f: np.save(f, table))
+    likelihood_tables[key] = table
+    return min_offset, table
+
+def offset_kernel(offsets, tail_range, f, prob_f, cache_dir=None):
+    """Gathers the P(d|L) nominators for the given offsets (offsets x L)
+       from the likelihood table."""
+    min_offset, table = likelihood_table(tail_range, f, prob_f, cache_dir)
+    rows = np.asarray(offsets, dtype=int) - min_offset
+    inside = (rows >= 0) & (rows < table.shape[0])
+    kernel = np.zeros((len(rows), table.shape[1]))
+    kernel[inside] = table[rows[inside]]
+    return kernel
+
+def offset_log_likelihoods(reads, tail_range, pAi, interval, f, prob_f,
+                           cache_dir=None, banded=False):
+    """Computes the log-likelihoods log P(d|L) (up to a constant per read)
+       once per unique read coordinate, treating the given interval as the
+       tail, from the likelihood table (banded if banded is True). Returns
+       the unique read coordinates, their counts, the log-likelihood matrix
+       (unique reads x L) and a boolean matrix marking zero likelihoods (for
+       which the log-likelihood is set to 0)."""
+    reads, counts = np.unique(np.asarray(reads, dtype=int),
+                              return_counts=True)
+    offsets = int(pAi[interval]['start']) - reads
+    if banded:
+        table = banded_likelihood_table(tail_range, f, prob_f, cache_dir)
+        kernel = banded_kernel(table, banded_rows(table, offsets),
+                               np.asarray(tail_range))
+    else:
+        kernel = offset_kernel(offsets, tail_range, f, prob_f, cache_dir)
+    zero = kernel == 0
+    return reads, counts, np.log(np.where(zero, 1, kernel)), zero
+
+def tail_length_posteriors(counts, log_kernel, zero):
+    """Computes tail length posteriors (homogeneous prior) for each row of
+       a (replicates x unique reads) count matrix in one matrix product."""
+    log_posterior = np.dot(counts, log_kernel)
+    log_posterior[np.dot(counts > 0, zero)] = -np.inf
+    log_posterior -= log_posterior.max(axis=1)[:, None]
+    posterior = np.exp(log_posterior)
+    return posterior / posterior.sum(axis=1)[:, None]
+
+def estimate_poly_tail_length_table(reads, tail_range, pAi, interval, f,
+                                    prob_f, cache_dir=None):
+    """Same as estimate_poly_tail_length (not weighted), but gathering the
+       likelihoods from the likelihood table shared across genes."""
+    reads, counts, log_kernel, zero = offset_log_likelihoods(reads,
+                                                             tail_range, pAi,
+                                                             interval, f,
+                                                             prob_f, cache_dir)
+    return [float(value) for value in
+            tail_length_posteriors(counts[None, :], log_kernel, zero)[0]]
+
+def bootstrap_tail_length(reads, tail_range, pAi, interval, f, prob_f,
+                          replicates=1000, confidence=.95, cache_dir=None,
+                          banded=False):
+    """Computes bootstrap confidence intervals for the MAP and mean polyA
+       tail length estimated as in estimate_poly_tail_length (not weighted).
+       The read counts per unique coordinate are resampled multinomially
+       and all replicates are evaluated together. Likelihoods are taken
+       from the banded likelihood table if banded is True, as by
+       estimate_poly_tail_length_banded. Returns a dictionary with 'map'
+       and 'mean', each a tuple (estimate, lower bound, upper bound)."""
+    tail_range = np.asarray(tail_range)
+    reads, counts, log_kernel, zero = offset_log_likelihoods(reads,
+                                                             tail_range, pAi,
+                                                             interval, f,
+                                                             prob_f, cache_dir,
+                                                             banded)
+    resampled = np.random.multinomial(counts.sum(), counts / counts.sum(),
+                                      size=replicates)
+    posteriors = tail_length_posteriors(np.vstack([counts, resampled]),
+                                        log_kernel, zero)
+    quantiles = [50 * (1 - confidence), 50 * (1 + confidence)]
+    estimates = {'map' : tail_range[np.argmax(posteriors, axis=1)],
+                 'mean' : np.dot(posteriors, tail_range)}
+    return dict((statistic, tuple(float(value) for value in
+                                  [values[0]]
+                                  + list(np.percentile(values[1:],
+                                                       quantiles))))
+                for statistic, values in estimates.items())
+
+# Banded likelihood tables: For an offset o, the P(d|L) nominator (see
+# likelihood_table) is zero for tail lengths L too short for the smallest
+# fragment size >= o to reach the tail, and saturates to P(f >= o) / L
+# for tail lengths longer than max(f) - o. Only the band of tail lengths
+# in between is stored (as sparse matrix rows), so the size of the table
+# and the cost of evaluating it are bounded by the width of the profile
+# rather than the tail length grid, which allows profiles and tail length
+# grids at 1 nt resolution. Tail length ranges have to be sorted.
+
+def likelihood_band(offsets, tail_range, f):
+    """Returns the indices of the first nonzero and of the first saturated
+       tail length (both len(tail_range) if none) for each offset."""
+    offsets = np.asarray(offsets)
+    tail_range = np.asarray(tail_range)
+    smallest = np.asarray(f)[np.minimum(np.searchsorted(f, offsets),
+                                        len(f) - 1)]
+    first = np.where(smallest >= offsets,
+                     np.searchsorted(tail_range, smallest - offsets + 1),
+                     len(tail_range))
+    last = np.maximum(first, np.searchsorted(tail_range,
+                                             max(f) - offsets + 1))
+    return first, last
+
+def banded_likelihood_table(tail_range, f, prob_f, cache_dir=None):
+    """Banded version of likelihood_table for the same offsets plus an
+       empty last row standing for all offsets outside the table. Returns a
+       dictionary with 'min_offset', 'first' and 'last' (see
+       likelihood_band), 'saturated' (P(f >= o) per row) and 'band' (rows x
+       L sparse matrix holding the band of each row). Memoized and cached
+       like likelihood_table."""
+    from scipy.sparse import csr_matrix
+    key = 'banded_' + likelihood_table_key(tail_range, f, prob_f)
+    if key in likelihood_tables:
+        return likelihood_tables[key]
+    if cache_dir is not None:
+        cache_file = os.path.join(cache_dir, 'likelihood_table_%s.npz' % key)
+        if os.path.isfile(cache_file):
+            with np.load(cache_file) as cached:
+                table = dict(cached)
+            table['min_offset'] = int(table['min_offset'])
+            table['band'] = csr_matrix((table.pop('data'),
+                                        table.pop('indices'),
+                                        table.pop('indptr')),
+                                       shape=(len(table['first']),
+                                              len(tail_range)))
+            likelihood_tables[key] = table
+            return table
+    tail_range = np.asarray(tail_range)
+    min_offset = int(min(f) - max(tail_range) + 1)
+    offsets = np.arange(min_offset, int(max(f)) + 1)
+    first, last = likelihood_band(offsets, tail_range, f)
+    first = np.append(first, len(tail_range))
+    last = np.append(last, len(tail_range))
+    widths = last - first
+    indptr = np.concatenate([[0], np.cumsum(widths)])
+    rows = np.repeat(np.arange(len(offsets)), widths[:-1])
+    indices = np.arange(indptr[-1]) - indptr[rows] + first[rows]
+    data = profile_mass_between(offsets[rows] - 1,
+                                offsets[rows] + tail_range[indices], f,
+                                prob_f) / tail_range[indices]
+    saturated = np.append(profile_mass_between(offsets - 1, np.inf, f,
+                                               prob_f), 0)
+    table = {'min_offset' : min_offset, 'first' : first, 'last' : last,
+             'saturated' : saturated,
+             'band' : csr_matrix((data, indices, indptr),
+                                 shape=(len(first), len(tail_range)))}
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        write_atomically(cache_file, lambda f: np.savez(
+            f, min_offset=min_offset, first=first, last=last,
+            saturated=saturated, data=data, indices=indices, indptr=indptr))
+    likelihood_tables[key] = table
+    return table
+
+def banded_rows(table, offsets):
+    """Rows of a banded likelihood table for the given offsets."""
+    rows = np.asarray(offsets, dtype=int) - table['min_offset']
+    return np.where((rows >= 0) & (rows < len(table['first']) - 1), rows,
+                    len(table['first']) - 1)
+
+def banded_kernel(table, rows, tail_range):
+    """Returns the P(d|L) nominators of the given table rows for all L as
+       dense matrix (rows x L), like offset_kernel."""
+    saturated = np.arange(len(tail_range)) >= table['last'][rows][:, None]
+    return (table['band'][rows].toarray()
+            + saturated * (table['saturated'][rows][:, None] / tail_range))
+
+def banded_dot(table, rows, vector, tail_range):
+    """Computes sum_L P(d|L) * vector[L] for each of the given table rows."""
+    suffix = np.append(np.cumsum((vector / tail_range)[::-1])[::-1], 0)
+    return (table['band'][rows].dot(vector)
+            + table['saturated'][rows] * suffix[table['last'][rows]])
+
+def banded_weighted_sum(table, rows, weights, tail_range):
+    """Computes sum_d weights[d] * P(d|L) over the given table rows for
+       each L."""
+    saturated = np.bincount(table['last'][rows],
+                            weights=weights * table['saturated'][rows],
+                            minlength=len(tail_range) + 1)
+    return (table['band'][rows].T.dot(weights)
+            + np.cumsum(saturated)[:len(tail_range)] / tail_range)
+
+def banded_log_likelihood(table, rows, counts, tail_range):
+    """Computes sum_d counts[d] * log P(d|L) over the given table rows for
+       each L (-inf where some read has zero likelihood)."""
+    band = table['band'][rows]
+    with np.errstate(divide='ignore'):
+        band.data = np.log(band.data)
+        log_saturated = np.log(table['saturated'][rows])
+    saturated = np.bincount(table['last'][rows],
+                            weights=counts * log_saturated,
+                            minlength=len(tail_range) + 1)
+    saturated_counts = np.bincount(table['last'][rows], weights=counts,
+                                   minlength=len(tail_range) + 1)
+    log_likelihood = (band.T.dot(counts.astype(float))
+                      + np.cumsum(saturated)[:len(tail_range)]
+                      - np.cumsum(saturated_counts)[:len(tail_range)]
+                      * np.log(tail_range))
+    log_likelihood[:np.max(table['first'][rows], initial=0)] = -np.inf
+    return log_likelihood
+
+def interval_log_likelihood(reads, tail_range, pAi, interval, f, prob_f,
+                            cache_dir=None, banded=False):
+    """Computes sum_d log P(d|L) over the reads for each L (-inf where some
+       read has zero likelihood), treating the given interval as the tail,
+       from the likelihood table (banded if banded is True)."""
+    if not banded:
+        reads, counts, log_kernel, zero = offset_log_likelihoods(
+            reads, tail_range, pAi, interval, f, prob_f, cache_dir)
+        log_likelihood = np.dot(counts, log_kernel)
+        log_likelihood[np.dot(counts > 0, zero)] = -np.inf
+        return log_likelihood
+    tail_range = np.asarray(tail_range)
+    reads, counts = np.unique(np.asarray(reads, dtype=int),
+                              return_counts=True)
+    table = banded_likelihood_table(tail_range, f, prob_f, cache_dir)
+    rows = banded_rows(table, int(pAi[interval]['start']) - reads)
+    return banded_log_likelihood(table, rows, counts, tail_range)
+
+def estimate_poly_tail_length_banded(reads, tail_range, pAi, interval, f,
+                                     prob_f, cache_dir=None):
+    """Same as estimate_poly_tail_length_table, but evaluating the banded
+       likelihood table."""
+    log_posterior = interval_log_likelihood(reads, tail_range, pAi, interval,
+                                            f, prob_f, cache_dir, True)
+    posterior = np.exp(log_posterior - log_posterior.max())
+    return [float(value) for value in posterior / posterior.sum()]
+
+def estimate_poly_tail_length_early_stopping(reads, tail_range, pAi,
+                                             interval, f, prob_f,
+                                             stop_probability, batch_size=50,
+                                             cache_dir=None, banded=False):
+    """Same as estimate_poly_tail_length_table (or _banded if banded is
+       True), but adding the reads in batches of batch_size and stopping
+       after the first batch leaving a MAP probability of at least
+       stop_probability. Returns the probabilities and the number of reads
+       used (the first ones)."""
+    log_posterior = np.zeros(len(tail_range))
+    used = 0
+    while True:
+        batch = reads[used:(used + batch_size)]
+        used += len(batch)
+        log_posterior += interval_log_likelihood(batch, tail_range, pAi,
+                                                 interval, f, prob_f,
+                                                 cache_dir, banded)
+        posterior = np.exp(log_posterior - log_posterior.max())
+        posterior /= posterior.sum()
+        if used == len(reads) or posterior.max() >= stop_probability:
+            return [float(value) for value in posterior], used
+
+def estimate_pAi_usage_and_tail_length_banded(reads, tail_range, pAi, f,
+                                              prob_f, max_iterations=1000,
+                                              tolerance=1e-10,
+                                              cache_dir=None):
+    """Same as estimate_pAi_usage_and_tail_length, but evaluating the banded
+       likelihood table for tail intervals instead of holding the reads x
+       intervals x L kernel, so that memory and time per iteration scale
+       with the bands of the reads rather than the tail length grid."""
+    tail_range = np.asarray(tail_range)
+    reads, counts = np.unique(np.asarray(reads, dtype=int),
+                              return_counts=True)
+    table = banded_likelihood_table(tail_range, f, prob_f, cache_dir)
+    is_tail = np.array([bool(interval['is_tail']) for interval in pAi])
+    # Table rows of the reads for tail intervals, likelihoods (independent
+    # of L) for internal priming intervals
+    rows = [banded_rows(table, int(interval['start']) - reads)
+            for interval in pAi]
+    likelihoods = np.array([np.zeros(len(reads)) if interval['is_tail'] else
+                            profile_mass_between(
+                                int(interval['start']) - reads,
+                                int(interval['end']) - reads, f, prob_f)
+                            / (int(interval['end']) - int(interval['start']))
+                            for interval in pAi]).reshape(len(pAi), -1)
+    explained = np.zeros(len(reads), dtype=bool)
+    for index in range(len(pAi)):
+        if is_tail[index]:
+            explained |= table['first'][rows[index]] < len(tail_range)
+        else:
+            explained |= likelihoods[index] > 0
+    counts = counts[explained]
+    likelihoods = likelihoods[:, explained]
+    rows = [interval_rows[explained] for interval_rows in rows]
+    weights = np.full(len(pAi), 1 / len(pAi))
+    tail_probs = np.full(len(tail_range), 1 / len(tail_range))
+    log_likelihood = -np.inf
+    for iteration in range(max_iterations):
+        # E step: likelihoods of each interval for each read, marginalized
+        # over L
+        marginals = likelihoods * tail_probs.sum()
+        for index in np.flatnonzero(is_tail):
+            marginals[index] = banded_dot(table, rows[index], tail_probs,
+                                          tail_range)
+        joint = marginals * weights[:, None]
+        read_probs = joint.sum(axis=0)
+        responsibilities = counts / read_probs
+
+        # M step: interval weights and tail length distribution
+        tail_counts = np.zeros(len(tail_range))
+        for index in np.flatnonzero(is_tail):
+            tail_counts += weights[index] * banded_weighted_sum(
+                table, rows[index], responsibilities, tail_range)
+        tail_counts *= tail_probs
+        weights = np.dot(joint, responsibilities) / counts.sum()
+        if tail_counts.sum() > 0:
+            tail_probs = tail_counts / tail_counts.sum()
+
+        previous_log_likelihood = log_likelihood
+        log_likelihood = np.dot(counts, np.log(read_probs))
+        if (log_likelihood - previous_log_likelihood
+                <= tolerance * abs(log_likelihood)):
+            break
+    return weights, tail_probs
+
+
 def estimate_poly_tail_length(reads, tail_range, pAi, interval, f, prob_f,
                               weighted):
     """Takes a set of reads (list of read_coordinates), a range of polyA tail
@@ -392,6 +702,114 @@ def estimate_poly_tail_length(reads, tail_range, pAi, interval, f, prob_f,
     norm_factor = sum(nominator)
     return [float(value/norm_factor) for value in nominator]
 
+def read_bamfile_by_gene(bamfile):
+    """Reads a text dump of a bamfile sorted or grouped by gene and yields
+       one (gene, reads) tuple per gene, reads being lists of [position,
+       strand, UMI] as in the pipeline. Only the reads of the current gene
+       are held in memory."""
+    seen = set()
+    rows = (row.strip().split() for row in read_lines(bamfile))
+    for gene, gene_rows in itertools.groupby(rows,
+                                             key=lambda columns:
+                                             columns[12][8:]):
+        if gene in seen:
+            raise ValueError('reads of gene %s are not grouped together '
+                             'in %s' % (gene, bamfile))
+        seen.add(gene)
+        yield gene, [[columns[3], columns[11], columns[18]]
+                     for columns in gene_rows]
+
+def read_coordinates_by_gene(coordinates):
+    """Reads read coordinates per gene (one 'gene,coordinate, coordinate,
+       ...' line per gene, as written by the simulate command) and yields
+       one (gene, reads) tuple per gene, reads being [position] lists."""
+    for line in read_lines(coordinates):
+        gene, *reads = line.rstrip('\n').split(',')
+        yield gene, [[read.strip()] for read in reads if read.strip()]
+
+def collapse_pcr_duplicates(reads):
+    """Removes reads with identical position, strand and UMI."""
+    reads = sorted(reads)
+    return [read for read, _ in itertools.groupby(reads)]
+
+def select_reads(reads, pAi, interval, f):
+    """Returns the coordinates of all reads close enough to the interval
+       (any of the intervals if interval is None) to be explained by the
+       bioanalyzer profile."""
+    if interval is None:
+        starts = [int(pAi_interval['start']) for pAi_interval in pAi]
+    else:
+        starts = [int(pAi[interval]['start'])]
+    return [int(read[0]) for read in reads
+            if any(start - int(read[0]) <= max(f) for start in starts)]
+
+def subsample_reads(reads, max_reads=None):
+    """Returns the reads in random order, at most max_reads of them."""
+    return np.random.permutation(np.asarray(reads, dtype=int))[
+        :max_reads].tolist()
+
+def estimate_tail_lengths_streaming(reads_by_gene, genes, pAi_full,
+                                    tail_range, f, prob_f, min_reads=100,
+                                    queue_size=0, joint=False,
+                                    cache_dir=None, collapse_duplicates=True,
+                                    banded=False, max_reads=None,
+                                    stop_probability=None):
+    """Estimates polyA tail lengths one gene at a time from (gene, reads)
+       tuples, e.g. from read_bamfile_by_gene. Genes not in genes are
+       skipped. PCR duplicates are collapsed unless collapse_duplicates is
+       False. Yields (gene, selected reads, probabilities), probabilities
+       being None for genes with less than min_reads reads. If joint is
+       True, all intervals of a gene are fitted together and probabilities
+       are (interval weights, tail length probabilities) as returned by
+       estimate_pAi_usage_and_tail_length. Otherwise, likelihoods are taken
+       from the likelihood table (see likelihood_table for cache_dir).
+       If banded is True, the banded likelihood table is evaluated instead
+       (see banded_likelihood_table), which is preferable for profiles
+       and tail length grids at fine resolution.
+       If max_reads or stop_probability are given, the reads of genes with
+       at least min_reads reads are put in random order and at most
+       max_reads of them are used, stopping early once the MAP probability
+       reaches stop_probability (see
+       estimate_poly_tail_length_early_stopping, not for joint estimation).
+       The selected reads yielded are the ones used then.
+       Memory is bounded by the largest gene (times queue_size + 1 if
+       queue_size > 0, in which case parsing runs ahead in a background
+       thread)."""
+    if joint and stop_probability is not None:
+        raise ValueError('Early stopping is not available for joint '
+                         'estimation')
+    genes = set(genes)
+    reads_by_gene = ((gene, reads) for gene, reads in reads_by_gene
+                     if gene in genes)
+    if queue_size > 0:
+        reads_by_gene = prefetch(reads_by_gene, queue_size)
+    for gene, reads in reads_by_gene:
+        if collapse_duplicates:
+            reads = collapse_pcr_duplicates(reads)
+        reads = select_reads(reads, pAi_full[gene], None if joint else 0, f)
+        if len(reads) < min_reads:
+            yield gene, reads, None
+            continue
+        if max_reads is not None or stop_probability is not None:
+            reads = subsample_reads(reads, max_reads)
+        if stop_probability is not None:
+            probs, used = estimate_poly_tail_length_early_stopping(
+                reads, tail_range, pAi_full[gene], 0, f, prob_f,
+                stop_probability, cache_dir=cache_dir, banded=banded)
+            yield gene, reads[:used], probs
+        elif joint and banded:
+            yield gene, reads, estimate_pAi_usage_and_tail_length_banded(
+                reads, tail_range, pAi_full[gene], f, prob_f,
+                cache_dir=cache_dir)
+        elif joint:
+            yield gene, reads, estimate_pAi_usage_and_tail_length(
+                reads, tail_range, pAi_full[gene], f, prob_f)
+        elif banded:
+            yield gene, reads, estimate_poly_tail_length_banded(
+                reads, tail_range, pAi_full[gene], 0, f, prob_f, cache_dir)
+        else:
+            yield gene, reads, estimate_poly_tail_length_table(
+                reads, tail_range, pAi_full[gene], 0, f, prob_f, cache_dir)
 
 ########
 # main #
@@ -399,4 +817,5 @@ def estimate_poly_tail_length(reads, tail_range, pAi, interval, f, prob_f,
 
 # Only run the following code if this module is run directly
 if __name__ == '__main__':
-    print (0)
+    from polyA import main
+    sys.exit(main())
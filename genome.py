@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+
+
+#########
+# about #
+#########
+
+__version__ = "0.1.0"
+__author__ = ["Nikolaos Karaiskos","Marcel Schilling"]
+__credits__ = ["Nikolaos Karaiskos","Mireya Plass Pórtulas","Marcel Schilling","Nikolaus Rajewsky"]
+__status__ = "beta"
+__licence__ = "GPL"
+__email__ = "marcel.schilling@mdc-berlin.de"
+
+
+###########
+# imports #
+###########
+
+import os
+import numpy as np
+from annotation import open_file
+
+
+#############
+# functions #
+#############
+
+# A genome cache is a directory holding the genome as one byte per base
+# (the FASTA characters without line breaks) in sequence.bin, which is
+# memory-mapped on opening, and the chromosome offset table index.tsv
+# (chromosome, first and last (exclusive) byte).
+
+def pack_genome(genome, cache):
+    """Converts a FASTA genome (file name, '-' for STDIN) into a genome
+       cache directory. Chromosome names are the first word of the FASTA
+       headers as in extract_pAi_from_genome."""
+    os.makedirs(cache, exist_ok=True)
+    index = []
+    position = 0
+    with open_file(genome) as f, \
+            open(os.path.join(cache, 'sequence.bin'), 'wb') as sequence:
+        for line in f:
+            line = line.rstrip('\n')
+            if '>' in line:
+                index.append([str(line.split()[0][1:]), position, position])
+                continue
+            sequence.write(line.encode())
+            position += len(line)
+            index[-1][2] = position
+    with open(os.path.join(cache, 'index.tsv'), 'w') as f:
+        for chromosome in index:
+            f.write('%s\t%i\t%i\n' % tuple(chromosome))
+
+def open_genome(cache):
+    """Opens a genome cache, returning a list of (chromosome, sequence)
+       tuples in FASTA order, sequences being memory-mapped uint8 arrays of
+       the bases' ASCII codes."""
+    with open(os.path.join(cache, 'index.tsv'), 'r') as f:
+        index = [line.rstrip('\n').split('\t') for line in f]
+    if os.path.getsize(os.path.join(cache, 'sequence.bin')) == 0:
+        return [(chromosome, np.zeros(0, dtype=np.uint8))
+                for chromosome, first, last in index]
+    sequence = np.memmap(os.path.join(cache, 'sequence.bin'), dtype=np.uint8,
+                         mode='r')
+    return [(chromosome, sequence[int(first):int(last)])
+            for chromosome, first, last in index]
+
+def cumulative_counts(values):
+    """Cumulative counts of True values, starting with 0."""
+    return np.concatenate([[0], np.cumsum(values, dtype=np.int32)])
+
+def run_lengths(values):
+    """Length of the run of True values ending at each position."""
+    positions = np.arange(1, len(values) + 1, dtype=np.int32)
+    last_false = np.maximum.accumulate(np.where(values, 0, positions))
+    return positions - last_false
+
+def base_statistics(is_base, consecutives):
+    """Precomputes the cumulative counts of a base and, for each run length
+       in consecutives, of the ends of runs at least that long."""
+    runs = run_lengths(is_base)
+    return (cumulative_counts(is_base),
+            dict((consecutive, cumulative_counts(runs >= consecutive))
+                 for consecutive in consecutives))
+
+def qualifying_windows(statistics, window, occurences, consecutive):
+    """Tests for each window whether it contains consecutive bases in a row
+       or at least occurences bases, given the base_statistics."""
+    counts, long_runs = statistics
+    long_runs = long_runs[consecutive]
+    # A window [c, c + window) contains a long enough run iff one ends at
+    # some i with c + consecutive - 1 <= i < c + window
+    n_windows = len(counts) - window
+    run_start = min(consecutive, window + 1) - 1
+    return ((long_runs[window:] > long_runs[run_start:(run_start + n_windows)])
+            | (counts[window:] - counts[:n_windows] >= occurences))
+
+def merge_windows(starts, plus, window):
+    """Merges consecutive qualifying windows on the same strand overlapping
+       or touching each other as in extract_pAi_from_genome. Returns the
+       merged starts, ends and strand indicators."""
+    if len(starts) == 0:
+        return starts, starts, plus
+    breaks = np.flatnonzero((np.diff(starts) > window)
+                            | (plus[1:] != plus[:-1])) + 1
+    firsts = np.concatenate([[0], breaks])
+    lasts = np.concatenate([breaks - 1, [len(starts) - 1]])
+    return starts[firsts], starts[lasts] + window, plus[firsts]
+
+def scan_pAi_parameters(cache, parameters, chunk_size=1 << 24):
+    """Scans a genome cache for pAi under several definitions at once.
+       parameters is a list of (window, occurences, consecutive) tuples as
+       used by extract_pAi_from_genome. Base counts and run lengths are
+       computed once per chunk of chunk_size window starts and shared by
+       all definitions. Returns a dictionary mapping each parameter
+       tuple to its list of merged (chromosome, start, end, strand) pAi, as
+       yielded by scan_pAi."""
+    parameters = [tuple(parameter) for parameter in parameters]
+    max_window = max(parameter[0] for parameter in parameters)
+    consecutives = set(parameter[2] for parameter in parameters)
+    pAi = dict((parameter, []) for parameter in parameters)
+    for chromosome, sequence in open_genome(cache):
+        windows = dict((parameter, ([], [])) for parameter in parameters)
+        for chunk_start in range(0, len(sequence), chunk_size):
+            chunk = np.asarray(sequence[chunk_start:(chunk_start + chunk_size
+                                                     + max_window - 1)])
+            A = base_statistics(chunk == ord('A'), consecutives)
+            T = base_statistics(chunk == ord('T'), consecutives)
+            for window, occurences, consecutive in parameters:
+                if len(chunk) < window:
+                    continue
+                plus = qualifying_windows(A, window, occurences,
+                                          consecutive)[:chunk_size]
+                minus = qualifying_windows(T, window, occurences,
+                                           consecutive)[:chunk_size]
+                starts = np.flatnonzero(plus | minus)
+                windows[(window, occurences, consecutive)][0].append(
+                    starts + chunk_start)
+                windows[(window, occurences, consecutive)][1].append(
+                    plus[starts])
+        for parameter in parameters:
+            if not windows[parameter][0]:
+                continue
+            starts, ends, plus = merge_windows(
+                np.concatenate(windows[parameter][0]),
+                np.concatenate(windows[parameter][1]), parameter[0])
+            pAi[parameter].extend(
+                (chromosome, int(start), int(end), '+' if strand else '-')
+                for start, end, strand in zip(starts, ends, plus))
+    return pAi
+
+def write_pAi_parameter_sweep(cache, parameters, folder, chunk_size=1 << 24):
+    """Writes one pAi BED file per parameter tuple (window, occurences,
+       consecutive) to folder, named pAi_<window>_<occurences>_<consecutive>.bed,
+       scanning the genome cache only once."""
+    os.makedirs(folder, exist_ok=True)
+    for parameter, intervals in scan_pAi_parameters(cache, parameters,
+                                                    chunk_size).items():
+        with open(os.path.join(folder, 'pAi_%i_%i_%i.bed' % parameter),
+                  'w') as f:
+            for interval in intervals:
+                f.write('%s\t%i\t%i\t.\t%s\n' % interval)
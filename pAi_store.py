@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+
+#########
+# about #
+#########
+
+__version__ = "0.1.0"
+__author__ = ["Nikolaos Karaiskos","Marcel Schilling"]
+__credits__ = ["Nikolaos Karaiskos","Mireya Plass Pórtulas","Marcel Schilling","Nikolaus Rajewsky"]
+__status__ = "beta"
+__licence__ = "GPL"
+__email__ = "marcel.schilling@mdc-berlin.de"
+
+
+###########
+# imports #
+###########
+
+import os
+import numpy as np
+from annotation import open_file
+
+
+#############
+# functions #
+#############
+
+# A pAi store is a directory holding the pAi intervals as binary arrays
+# that are memory-mapped on opening:
+#   start.npy, end.npy: 0-based open interval coordinates (int64)
+#   name.npy:           BED name fields (fixed width bytes)
+#   index.tsv:          chromosome, strand, first and last (exclusive)
+#                       array index and maximal interval length of each
+#                       chromosome/strand block
+# Within each block, intervals are sorted by start and end coordinate.
+
+def write_pAi_store(pAi_bed, store):
+    """Converts a pAi BED file (as written by extract_pAi_from_genome or
+       annotate_pAi_with_gene) into a pAi store directory."""
+    blocks = {}
+    with open_file(pAi_bed) as f:
+        for line in f:
+            chr, start, end, name, strand = line.rstrip('\n').split('\t')[:5]
+            blocks.setdefault((chr, strand.strip()), []).append(
+                (int(start), int(end), name))
+    starts = []
+    ends = []
+    names = []
+    index = []
+    for chr, strand in sorted(blocks):
+        intervals = sorted(blocks[(chr, strand)])
+        first = len(starts)
+        starts.extend(interval[0] for interval in intervals)
+        ends.extend(interval[1] for interval in intervals)
+        names.extend(interval[2] for interval in intervals)
+        max_length = max(interval[1] - interval[0] for interval in intervals)
+        index.append((chr, strand, first, len(starts), max_length))
+    os.makedirs(store, exist_ok=True)
+    np.save(os.path.join(store, 'start.npy'), np.array(starts, dtype=np.int64))
+    np.save(os.path.join(store, 'end.npy'), np.array(ends, dtype=np.int64))
+    np.save(os.path.join(store, 'name.npy'),
+            np.array([name.encode() for name in names], dtype=bytes))
+    with open(os.path.join(store, 'index.tsv'), 'w') as f:
+        for block in index:
+            f.write('%s\t%s\t%i\t%i\t%i\n' % block)
+
+def open_pAi_store(store):
+    """Opens a pAi store, memory-mapping its arrays."""
+    index = {}
+    with open(os.path.join(store, 'index.tsv'), 'r') as f:
+        for line in f:
+            chr, strand, first, last, max_length = line.rstrip('\n').split('\t')
+            index[(chr, strand)] = (int(first), int(last), int(max_length))
+    return {'index' : index,
+            'start' : np.load(os.path.join(store, 'start.npy'), mmap_mode='r'),
+            'end' : np.load(os.path.join(store, 'end.npy'), mmap_mode='r'),
+            'name' : np.load(os.path.join(store, 'name.npy'), mmap_mode='r')}
+
+def overlapping_pAi_indices(store, chromosome, strand, start, end):
+    """Returns the array indices of all pAi on the given chromosome and
+       strand overlapping [start, end)."""
+    if (chromosome, strand) not in store['index']:
+        return np.arange(0)
+    first, last, max_length = store['index'][(chromosome, strand)]
+    starts = store['start'][first:last]
+
+    # Intervals starting more than max_length before start cannot reach it
+    lower = np.searchsorted(starts, start - max_length, side='right')
+    upper = np.searchsorted(starts, end, side='left')
+    candidates = np.arange(first + lower, first + upper)
+    return candidates[store['end'][candidates] > start]
+
+def query_pAi_store(store, chromosome, strand, start, end):
+    """Returns all pAi on the given chromosome and strand overlapping
+       [start, end) as interval dictionaries like those in
+       merge_pAi_and_utr_intervals."""
+    return [{'start' : int(store['start'][index]),
+             'end' : int(store['end'][index]),
+             'strand' : strand, 'is_tail' : False,
+             'name' : store['name'][index].decode()}
+            for index in overlapping_pAi_indices(store, chromosome, strand,
+                                                 start, end)]
+
+def export_pAi_store(store, pAi_bed):
+    """Writes all intervals of an (opened) pAi store to a BED file."""
+    with open(pAi_bed, 'w') as f:
+        for (chr, strand), (first, last, _) in sorted(store['index'].items()):
+            for start, end, name in zip(store['start'][first:last],
+                                        store['end'][first:last],
+                                        store['name'][first:last]):
+                f.write('%s\t%i\t%i\t%s\t%s\n' % (chr, start, end,
+                                                  name.decode(), strand))
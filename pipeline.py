@@ -2,6 +2,7 @@
 
 import numpy as np
 from estimate_length import *
+from bam import *
 from collections import defaultdict
 import itertools	
 import os
@@ -18,6 +19,36 @@ gtf_url = 'ftp://ftp.ensembl.org/pub/release-84/gtf/homo_sapiens/Homo_sapiens.GR
 folder_in = 'test_data'
 gtf = os.path.join(folder_in, 'Homo_sapiens.GRCh38.84_chr9.gtf.gz')
 genome = os.path.join(folder_in, 'Homo_sapiens.GRCh38.dna.chromosome.9.fa')
+bamfile_txt = os.path.join(folder_in, 'ds_012_50fix_bamfile.txt.gz')
+
+# The bamfile itself. If it exists, it is read directly (only the 3'UTR
+# regions if indexed) instead of the text dump above.
+bamfile_bam = os.path.join(folder_in, 'ds_012_50fix.bam')
+read_bam_directly = os.path.isfile(bamfile_bam)
+
+# Estimate gene by gene while reading the bamfile instead of reading it
+# into memory first. Requires the bamfile to be sorted or grouped by gene.
+# Reading the bamfile directly streams the 3'UTRs of the genes analyzed if
+# the bamfile is indexed (.bai), otherwise it is read into memory as a
+# whole.
+stream_reads = False
+
+# Number of genes to parse ahead in a background thread while streaming
+# (0 to parse and estimate alternately in a single thread)
+prefetch_genes = 4
+
+# Fit 3'UTR isoform and pAi usage jointly with the tail length for all
+# genes instead of only using the single-UTR genes without pAi
+fit_pAi_usage = False
+
+# Number of bootstrap replicates for confidence intervals of the MAP and
+# mean tail lengths (0 to skip, not available with fit_pAi_usage)
+bootstrap_replicates = 0
+
+# Evaluate only the band of nonzero tail length likelihoods per read
+# (see banded_likelihood_table), recommended for bioanalyzer bins and
+# tail length steps of a few nucleotides
+banded_likelihoods = False
 
 # Create output directory for storing everything
 folder_out = os.path.join(folder_in, 'output')
@@ -26,6 +57,10 @@ try:
 except Exception:
     pass
 
+# Directory to store likelihood tables in for reuse by runs sharing the
+# bioanalyzer profile and tail range
+kernel_cache = os.path.join(folder_out, 'likelihood_tables')
+
 print(folder_out)
 
 ### 1. Download annotation
@@ -43,10 +78,9 @@ if os.path.isfile(os.path.join(folder_out, 'utr_annotation.bed')):
     print ('skipping [ file already exists ]')
 else:
     start_time = time.time()
-    old_stdout = sys.stdout
-    sys.stdout = open(os.path.join(folder_out, 'utr_annotation_temp.bed'), 'w')
-    extract_three_prime_utr_information(gtf, bed_name_attributes = ["gene_name"])
-    sys.stdout = old_stdout
+    with open(os.path.join(folder_out, 'utr_annotation_temp.bed'), 'w') as utr_bed:
+        extract_three_prime_utr_information(gtf, bed_name_attributes = ["gene_name"],
+                                            output = utr_bed)
     print ('done [', round(time.time() - start_time, 2), 'seconds ]')
 
     ### 2.1 Clean utr from haplotypes and junk chromosomes
@@ -104,23 +138,26 @@ f_size, f_prob = discretize_bioanalyzer_profile(bio_size, bio_intensity, 10)
 print ('done [', round(time.time() - start_time, 2), 'seconds ]')
 
 ### 7. Read bamfile
-print ('reading bamfile into memory ...', end=" ", flush=True)
-start_time = time.time()
-bamfile = defaultdict(list)
-with gzip.open(os.path.join(folder_in, 'ds_012_50fix_bamfile.txt.gz'), 'rt') as f:
-    for columns in (row.strip().split() for row in f):
+if read_bam_directly and not os.path.isfile(bamfile_bam + '.bai'):
+    print ('reading unindexed bamfile into memory during estimation')
+elif stream_reads or read_bam_directly:
+    print ('reading bamfile gene by gene during estimation')
+else:
+    print ('reading bamfile into memory ...', end=" ", flush=True)
+    start_time = time.time()
+    bamfile = defaultdict(list)
+    for columns in (row.strip().split() for row in read_lines(bamfile_txt)):
         gene = columns[12][8:]
         bamfile[gene].append([columns[3], columns[11], columns[18]])
-print ('done [', round(time.time() - start_time, 2), 'seconds ]')
+    print ('done [', round(time.time() - start_time, 2), 'seconds ]')
 
 ### 8. Collapsing PCR duplicates
-print ('collapsing PCR duplicates ...', end=" ", flush=True)
-start_time = time.time()
-for gene in bamfile:
-    temp_list = bamfile[gene]
-    temp_list.sort()
-    bamfile[gene] = list(temp_list for temp_list,_ in itertools.groupby(temp_list))
-print ('done [', round(time.time() - start_time, 2), 'seconds ]')
+if not (stream_reads or read_bam_directly):
+    print ('collapsing PCR duplicates ...', end=" ", flush=True)
+    start_time = time.time()
+    for gene in bamfile:
+        bamfile[gene] = collapse_pcr_duplicates(bamfile[gene])
+    print ('done [', round(time.time() - start_time, 2), 'seconds ]')
 
 ### 9. Estimate tail lengths per gene.
 # focus on particular genes as examples (single 3'UTRs)
@@ -132,16 +169,9 @@ if os.path.isfile(os.path.join(folder_in, 'single_utr_no_pAi_genes.txt')):
 else:
     start_time = time.time()
     # see https://github.com/rajewsky-lab/polyA/pull/64#issuecomment-226303768
-    subprocess.call("zcat test_data/Homo_sapiens.GRCh38.84_chr9.gtf.gz | awk '$3 == \"three_prime_utr\" {print $18}' | sort | uniq -c | awk '$1 == 1 {print $2}' | cut -c2- | sed 's/..$//' > " + os.path.join(folder_in, 'single_utr_genes.txt'), shell=True)
-    subprocess.call("awk '{print $4}' test_data/output/pAi_gene.bed | uniq | sort | uniq > " + os.path.join(folder_in, 'pAi_genes.txt'), shell=True)
-    subprocess.call('comm -23 ' + os.path.join(folder_in, 'single_utr_genes.txt') + ' ' + os.path.join(folder_in, 'pAi_genes.txt') + ' > ' + os.path.join(folder_in, 'single_utr_no_pAi_genes.txt'), shell=True)
-    os.remove(os.path.join(folder_in, 'single_utr_genes.txt'))
-    os.remove(os.path.join(folder_in, 'pAi_genes.txt'))
-    # The following line doing the same using command substitution to
-    # avoid the temporary intermediate files results in a syntax error
-    # when called through subprocess even though it works when passed on
-    # to bash -c directly (escaping `$`s from the shall of course):
-    #subprocess.call("comm -23 <(zcat test_data/Homo_sapiens.GRCh38.84_chr9.gtf.gz | awk '$3 == \"three_prime_utr\" {print $18}' | sort | uniq -c | awk '$1 == 1 {print $2}' | cut -c2- | sed 's/..$//') <(awk '{print $4}' test_data/output/pAi_gene.bed | uniq | sort | uniq) > " + os.path.join(folder_in, 'single_utr_no_pAi_genes.txt'), shell=True)
+    with open_file(gtf) as gtf_lines, open(os.path.join(folder_out, 'pAi_gene.bed'), 'r') as pAi_gene_bed, open(os.path.join(folder_in, 'single_utr_no_pAi_genes.txt'), 'w') as fout:
+        for gene in single_utr_no_pAi_genes(gtf_lines, pAi_gene_bed):
+            fout.write(gene + '\n')
     print ('done [', round(time.time() - start_time, 2), 'seconds ]')
 
 print ('setting up a tail range of', end=" ")
@@ -157,23 +187,50 @@ with open(os.path.join(folder_in, 'single_utr_no_pAi_genes.txt'), 'r') as f:
         genes.append(line.rstrip())
 
 ### 11. iterate over all genes and predict tails
-with open (os.path.join(folder_out, 'tail_lengths.txt'), 'w') as results, open (os.path.join(folder_out, 'coverage.txt'), 'w') as cov:
-    for index in range(len(genes)):
-        gene = genes[index]
+if fit_pAi_usage:
+    genes = sorted(pAi_full)
+if read_bam_directly:
+    # Only the 3'UTRs of the genes analyzed
+    gene_set = set(genes)
+    with open(os.path.join(folder_out, 'utr_annotation.bed'), 'r') as utr_bed:
+        spans = utr_gene_spans(line for line in utr_bed
+                               if line.split('\t')[3] in gene_set)
+    reads_by_gene = read_bam_by_gene(bamfile_bam, spans)
+elif stream_reads:
+    reads_by_gene = read_bamfile_by_gene(bamfile_txt)
+else:
+    reads_by_gene = ((gene, bamfile[gene]) for gene in genes)
+estimates = estimate_tail_lengths_streaming(reads_by_gene, genes, pAi_full,
+                                            tail_range, f_size, f_prob,
+                                            min_reads=100,
+                                            queue_size=prefetch_genes,
+                                            joint=fit_pAi_usage,
+                                            cache_dir=kernel_cache,
+                                            banded=banded_likelihoods)
+with open (os.path.join(folder_out, 'tail_lengths.txt'), 'w') as results, open (os.path.join(folder_out, 'coverage.txt'), 'w') as cov, open (os.path.join(folder_out, 'pAi_usage.txt'), 'w') as usage, open (os.path.join(folder_out, 'tail_length_intervals.txt'), 'w') as intervals:
+    start_time = time.time()
+    for gene, reads, probs in estimates:
         print ('estimating polyA tail length for gene', gene, '...', end=" ", flush=True)
-        reads = []
-        for item in bamfile[gene]:
-            if (int(pAi_full[gene][0]['start']) - int(item[0]) <= max(f_size)):
-                reads.append(int(item[0]))
-        #reads = [ reads[i] for i in sorted(random.sample(range(len(reads)), 100)) ]
         # Put threshold for number of reads required
-        if len(reads) < 100:
+        if probs is None:
             print ('not enough reads for analysis [', len(reads), ']')
+            start_time = time.time()
             continue
-        print (len(reads), 'reads will be used for the analysis ...', end=" ", flush=True)
-        start_time = time.time()
-        probs = estimate_poly_tail_length(reads, tail_range, pAi_full[gene],
-                                          0, f_size, f_prob, False)
+        print (len(reads), 'reads were used for the analysis ...', end=" ", flush=True)
         print ('done [', round(time.time() - start_time, 2), 'seconds ]')
+        start_time = time.time()
+        if fit_pAi_usage:
+            weights, probs = probs
+            probs = probs.tolist()
+            usage.write(gene + ',' + str(weights.tolist()) + '\n')
+        elif bootstrap_replicates > 0:
+            bootstrap = bootstrap_tail_length(reads, tail_range,
+                                              pAi_full[gene], 0, f_size,
+                                              f_prob, bootstrap_replicates,
+                                              cache_dir=kernel_cache,
+                                              banded=banded_likelihoods)
+            intervals.write(gene + ',' + str(list(bootstrap['map']
+                                                  + bootstrap['mean']))
+                            + '\n')
         results.write(gene + ',' + str(probs) + '\n')
         cov.write(gene + ',' + str(list(int(pAi_full[gene][0]['start']) - np.array(reads))) + '\n')
@@ -0,0 +1,420 @@
+#!/usr/bin/env python3
+
+
+#########
+# about #
+#########
+
+__version__ = "0.1.0"
+__author__ = ["Nikolaos Karaiskos","Marcel Schilling"]
+__credits__ = ["Nikolaos Karaiskos","Mireya Plass Pórtulas","Marcel Schilling","Nikolaus Rajewsky"]
+__status__ = "beta"
+__licence__ = "GPL"
+__email__ = "marcel.schilling@mdc-berlin.de"
+
+
+###########
+# imports #
+###########
+
+# Only light-weight modules are imported here. The commands import what
+# they need: the text-only stages (gtf-to-utr, scan-pai, annotate-pai,
+# select-genes) only the numpy-free annotation module, so that these
+# stages of a pipe start quickly, the others numpy and the analysis
+# modules.
+import argparse
+import os
+import sys
+
+
+#########
+# usage #
+#########
+
+# Each command reads from STDIN and writes to STDOUT, so that stages can
+# be chained as OS pipes running concurrently, e.g.:
+#
+#   zcat genes.gtf.gz | ./polyA.py gtf-to-utr > utr.bed
+#   ./polyA.py scan-pai < genome.fa | ./polyA.py annotate-pai --utr utr.bed \
+#       | tee pAi_gene.bed | ./polyA.py build-index pAi_gene_store
+#   zcat genes.gtf.gz | ./polyA.py select-genes --pai pAi_gene.bed > genes.txt
+#   zcat bamfile.txt.gz | ./polyA.py estimate --utr utr.bed \
+#       --pai pAi_gene.bed --bioanalyzer bioanalyzer.txt --genes genes.txt
+#
+# To distribute the estimation over several machines sharing a
+# filesystem, write a work queue, start any number of workers and merge:
+#
+#   ./polyA.py queue shared/queue --reads reads.bam --utr utr.bed \
+#       --pai pAi_gene.bed --bioanalyzer bioanalyzer.txt < genes.txt
+#   ./polyA.py work shared/queue    # on each node
+#   ./polyA.py merge shared/queue > tail_lengths.txt
+
+
+############
+# commands #
+############
+
+def gtf_to_utr(arguments):
+    from annotation import extract_three_prime_utr_information
+    extract_three_prime_utr_information('-', bed_name_attributes =
+                                        arguments.attributes)
+
+def scan_pai(arguments):
+    from annotation import open_file, scan_pAi
+    with open_file('-') as genome:
+        for interval in scan_pAi(genome, arguments.window,
+                                 arguments.occurences, arguments.consecutive):
+            sys.stdout.write('%s\t%i\t%i\t.\t%s\n' % interval)
+
+def annotate_pai(arguments):
+    from annotation import open_file, utr_gene_spans, annotate_pAi
+    with open_file(arguments.utr) as utr_bed:
+        spans = utr_gene_spans(utr_bed)
+    with open_file('-') as pAi_bed:
+        for interval in annotate_pAi(pAi_bed, spans):
+            sys.stdout.write('%s\t%i\t%i\t%s\t%s\n' % interval)
+
+def select_genes(arguments):
+    from annotation import open_file, single_utr_no_pAi_genes
+    with open_file('-') as gtf, open_file(arguments.pai) as pAi_gene_bed:
+        for gene in single_utr_no_pAi_genes(gtf, pAi_gene_bed,
+                                            arguments.attribute):
+            print(gene)
+
+def build_index(arguments):
+    from pAi_store import write_pAi_store
+    write_pAi_store('-', arguments.store)
+
+def pack_genome(arguments):
+    from genome import pack_genome
+    pack_genome('-', arguments.cache)
+
+def sweep_pai(arguments):
+    from genome import write_pAi_parameter_sweep
+    write_pAi_parameter_sweep(arguments.cache, arguments.parameters,
+                              arguments.output)
+
+def parameter_tuple(value):
+    return tuple(int(field) for field in value.split(','))
+
+def read_profile(arguments):
+    from estimate_length import (read_bioanalyzer_profile,
+                                 discretize_bioanalyzer_profile)
+    size, intensity = read_bioanalyzer_profile(arguments.bioanalyzer)
+    return discretize_bioanalyzer_profile(size, intensity, arguments.bin_size)
+
+def estimate(arguments):
+    from estimate_length import (merge_pAi_and_utr_intervals, open_file,
+                                 tail_length_range, read_bamfile_by_gene,
+                                 read_coordinates_by_gene,
+                                 estimate_tail_lengths_streaming)
+    f_size, f_prob = read_profile(arguments)
+    pAi_full = merge_pAi_and_utr_intervals(arguments.utr, arguments.pai)
+    if arguments.genes is None:
+        genes = list(pAi_full)
+    else:
+        with open_file(arguments.genes) as f:
+            genes = [line.rstrip() for line in f]
+    if arguments.format == 'bamfile':
+        reads_by_gene = read_bamfile_by_gene('-')
+    else:
+        reads_by_gene = read_coordinates_by_gene('-')
+    tail_range = tail_length_range(*arguments.tail_range)
+    for gene, reads, probs in estimate_tail_lengths_streaming(
+            reads_by_gene, genes, pAi_full, tail_range, f_size, f_prob,
+            min_reads=arguments.min_reads, queue_size=arguments.prefetch,
+            joint=arguments.joint, cache_dir=arguments.cache_dir,
+            collapse_duplicates=arguments.format == 'bamfile',
+            banded=arguments.banded, max_reads=arguments.max_reads,
+            stop_probability=arguments.stop_probability):
+        if probs is None:
+            continue
+        if arguments.joint:
+            weights, probs = probs
+            probs = probs.tolist()
+        sys.stdout.write(gene + ',' + str(probs) + '\n')
+
+def simulate(arguments):
+    import numpy as np
+    from collections import defaultdict
+    from annotation import open_file
+    from simulate import simulate_reads
+    f_size, f_prob = read_profile(arguments)
+    pAi = defaultdict(list)
+    with open_file(arguments.utr) as f:
+        for line in f:
+            chr, start, end, gene, strand = line.rstrip('\n').split('\t')[:5]
+            pAi[gene].append({'start' : end, 'end' : 0, 'strand' : strand,
+                              'is_tail' : True})
+    with open_file('-') as f:
+        genes = [line.rstrip() for line in f]
+    if arguments.seed is not None:
+        np.random.seed(arguments.seed)
+    reads = simulate_reads(genes, pAi, f_size, f_prob,
+                           arguments.reads_per_gene, arguments.tail_length,
+                           arguments.min_offset)[2]
+    for gene in genes:
+        if gene in reads:
+            sys.stdout.write(gene + ',' + ', '.join(str(read) for read
+                                                    in reads[gene]) + '\n')
+
+def calibrate(arguments):
+    import numpy as np
+    from estimate_length import read_bioanalyzer_profile
+    from calibrate import calibrate, write_report
+    size, intensity = read_bioanalyzer_profile(arguments.bioanalyzer)
+    if arguments.seed is not None:
+        np.random.seed(arguments.seed)
+    settings = [dict(zip(['bin_size', 'tail_step', 'max_reads',
+                          'stop_probability', 'banded'], setting))
+                for setting in arguments.settings]
+    write_report(calibrate(size, intensity, arguments.distributions,
+                           arguments.coverages, settings, arguments.genes,
+                           *arguments.tail_range), sys.stdout)
+
+def make_queue(arguments):
+    import os
+    from annotation import open_file
+    from distribute import create_queue
+    with open_file('-') as f:
+        genes = [line.rstrip() for line in f]
+    # Absolute paths, workers may run in other directories
+    create_queue(arguments.queue, genes, arguments.chunk_size,
+                 {'utr' : os.path.abspath(arguments.utr),
+                  'pai' : os.path.abspath(arguments.pai),
+                  'bioanalyzer' : os.path.abspath(arguments.bioanalyzer),
+                  'bin_size' : arguments.bin_size,
+                  'tail_range' : arguments.tail_range,
+                  'reads' : os.path.abspath(arguments.reads),
+                  'format' : arguments.format,
+                  'min_reads' : arguments.min_reads,
+                  'joint' : arguments.joint,
+                  'banded' : arguments.banded,
+                  'max_reads' : arguments.max_reads,
+                  'stop_probability' : arguments.stop_probability,
+                  'cache_dir' : None if arguments.cache_dir is None
+                                else os.path.abspath(arguments.cache_dir)})
+
+def work(arguments):
+    from distribute import run_worker
+    run_worker(arguments.queue, arguments.worker, arguments.lease,
+               arguments.attempts)
+
+def merge(arguments):
+    from distribute import merge_results
+    if arguments.usage is None:
+        merge_results(arguments.queue, sys.stdout)
+    else:
+        with open(arguments.usage, 'w') as usage:
+            merge_results(arguments.queue, sys.stdout, usage)
+
+def banded_field(value):
+    if value != 'banded':
+        raise ValueError('not banded: ' + value)
+    return True
+
+def setting_tuple(value):
+    fields = value.split(',')
+    return (int(fields[0]), int(fields[1])) + tuple(
+        None if field == '' else converter(field)
+        for field, converter in zip(fields[2:], [int, float, banded_field]))
+
+
+##########
+# parser #
+##########
+
+def parser():
+    parser = argparse.ArgumentParser(description='Estimate polyA tail '
+                                     'lengths. Commands read from STDIN and '
+                                     'write to STDOUT.')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    command = commands.add_parser('gtf-to-utr', help="extract 3'UTR BED "
+                                  'from GTF')
+    command.add_argument('--attributes', nargs='+', default=['gene_name'],
+                         help='GTF attributes forming the BED name')
+    command.set_defaults(function=gtf_to_utr)
+
+    command = commands.add_parser('scan-pai', help='extract pAi BED from '
+                                  'FASTA genome')
+    command.add_argument('--window', type=int, default=10)
+    command.add_argument('--occurences', type=int, default=7)
+    command.add_argument('--consecutive', type=int, default=6)
+    command.set_defaults(function=scan_pai)
+
+    command = commands.add_parser('annotate-pai', help='annotate pAi BED '
+                                  'with genes')
+    command.add_argument('--utr', required=True, help="3'UTR BED")
+    command.set_defaults(function=annotate_pai)
+
+    command = commands.add_parser('select-genes', help='list single-UTR '
+                                  'genes without pAi from GTF')
+    command.add_argument('--pai', required=True, help='gene annotated pAi BED')
+    command.add_argument('--attribute', default='gene_name',
+                         help='GTF attribute identifying genes')
+    command.set_defaults(function=select_genes)
+
+    command = commands.add_parser('build-index', help='store pAi BED for '
+                                  'range queries')
+    command.add_argument('store', help='pAi store directory to write')
+    command.set_defaults(function=build_index)
+
+    command = commands.add_parser('pack-genome', help='store FASTA genome '
+                                  'as memory-mappable genome cache')
+    command.add_argument('cache', help='genome cache directory to write')
+    command.set_defaults(function=pack_genome)
+
+    command = commands.add_parser('sweep-pai', help='write pAi BED files '
+                                  'for several pAi definitions in one scan')
+    command.add_argument('--cache', required=True, help='genome cache')
+    command.add_argument('--output', required=True,
+                         help='directory to write the BED files to')
+    command.add_argument('parameters', nargs='+', type=parameter_tuple,
+                         metavar='WINDOW,OCCURENCES,CONSECUTIVE')
+    command.set_defaults(function=sweep_pai)
+
+    profile = argparse.ArgumentParser(add_help=False)
+    profile.add_argument('--bioanalyzer', required=True,
+                         help='bioanalyzer profile')
+    profile.add_argument('--bin-size', type=int, default=10)
+
+    command = commands.add_parser('estimate', parents=[profile],
+                                  help='estimate tail lengths from reads '
+                                  'grouped by gene')
+    command.add_argument('--utr', required=True, help="3'UTR BED")
+    command.add_argument('--pai', required=True, help='gene annotated pAi BED')
+    command.add_argument('--genes', help='genes to analyze (default: all)')
+    command.add_argument('--format', choices=['bamfile', 'coordinates'],
+                         default='bamfile', help='bamfile text dump or read '
+                         'coordinates per gene as written by simulate')
+    command.add_argument('--tail-range', type=int, nargs=3,
+                         default=[10, 550, 30],
+                         metavar=('START', 'END', 'STEP'))
+    command.add_argument('--min-reads', type=int, default=100)
+    command.add_argument('--joint', action='store_true',
+                         help='fit all 3\'UTR isoforms and pAi jointly')
+    command.add_argument('--cache-dir', help='likelihood table cache')
+    command.add_argument('--banded', action='store_true',
+                         help='evaluate only the nonzero band of the '
+                         'likelihood table (for --bin-size 1 and fine tail '
+                         'ranges)')
+    command.add_argument('--max-reads', type=int,
+                         help='use at most this many (random) reads per gene')
+    command.add_argument('--stop-probability', type=float,
+                         help='stop adding reads once the MAP tail length '
+                         'reaches this posterior probability (not with '
+                         '--joint)')
+    command.add_argument('--prefetch', type=int, default=4,
+                         help='genes to parse ahead in the background')
+    command.set_defaults(function=estimate)
+
+    command = commands.add_parser('simulate', parents=[profile],
+                                  help='simulate read coordinates for genes')
+    command.add_argument('--utr', required=True, help="3'UTR BED")
+    command.add_argument('--reads-per-gene', type=int, default=100)
+    command.add_argument('--tail-length', type=int, default=42)
+    command.add_argument('--min-offset', type=int, default=1)
+    command.add_argument('--seed', type=int)
+    command.set_defaults(function=simulate)
+
+    command = commands.add_parser('calibrate', help='report accuracy and '
+                                  'runtime of estimation settings on '
+                                  'simulated genes')
+    command.add_argument('--bioanalyzer', required=True,
+                         help='bioanalyzer profile')
+    command.add_argument('--genes', type=int, default=1000,
+                         help='genes to simulate per distribution and '
+                         'coverage')
+    command.add_argument('--distributions', nargs='+', default=[(40, 10),
+                                                                (100, 20)],
+                         type=lambda value: tuple(float(field) for field
+                                                  in value.split(',')),
+                         metavar='MEAN,SD', help='true tail length '
+                         'distributions (normal)')
+    command.add_argument('--coverages', nargs='+', type=int,
+                         default=[100, 1000], help='reads per gene')
+    command.add_argument('--settings', nargs='+', type=setting_tuple,
+                         default=[(10, 30), (5, 10), (5, 10, 200),
+                                  (5, 10, None, .99), (1, 1, None, None,
+                                                       True)],
+                         metavar='BIN_SIZE,TAIL_STEP[,MAX_READS[,STOP'
+                         '[,banded]]]')
+    command.add_argument('--tail-range', type=int, nargs=2, default=[10, 250],
+                         metavar=('START', 'END'))
+    command.add_argument('--seed', type=int)
+    command.set_defaults(function=calibrate)
+
+    command = commands.add_parser('queue', parents=[profile],
+                                  help='write a work queue of gene chunks '
+                                  '(genes from STDIN) to a shared directory')
+    command.add_argument('queue', help='work queue directory to write '
+                         '(new or empty)')
+    command.add_argument('--reads', required=True, help='reads: indexed BAM '
+                         'file, bamfile text dump or read coordinates per '
+                         'gene (text reads are split by chunk into the '
+                         'queue)')
+    command.add_argument('--format', choices=['bam', 'bamfile',
+                                              'coordinates'],
+                         default='bam')
+    command.add_argument('--utr', required=True, help="3'UTR BED")
+    command.add_argument('--pai', required=True, help='gene annotated pAi BED')
+    command.add_argument('--chunk-size', type=int, default=100,
+                         help='genes per chunk')
+    command.add_argument('--tail-range', type=int, nargs=3,
+                         default=[10, 550, 30],
+                         metavar=('START', 'END', 'STEP'))
+    command.add_argument('--min-reads', type=int, default=100)
+    command.add_argument('--joint', action='store_true',
+                         help='fit all 3\'UTR isoforms and pAi jointly')
+    command.add_argument('--banded', action='store_true',
+                         help='evaluate banded likelihood tables')
+    command.add_argument('--max-reads', type=int,
+                         help='use at most this many (random) reads per gene')
+    command.add_argument('--stop-probability', type=float,
+                         help='stop adding reads once the MAP tail length '
+                         'reaches this posterior probability')
+    command.add_argument('--cache-dir', help='likelihood table cache')
+    command.set_defaults(function=make_queue)
+
+    command = commands.add_parser('work', help='estimate chunks of a work '
+                                  'queue until none is left')
+    command.add_argument('queue', help='work queue directory')
+    command.add_argument('--worker', help='worker name (default: '
+                         'host:pid)')
+    command.add_argument('--lease', type=float, default=600,
+                         help='seconds without progress after which other '
+                         'workers take over a chunk')
+    command.add_argument('--attempts', type=int, default=3,
+                         help='maximal attempts per chunk')
+    command.set_defaults(function=work)
+
+    command = commands.add_parser('merge', help='write the tail lengths of '
+                                  'a finished work queue')
+    command.add_argument('queue', help='work queue directory')
+    command.add_argument('--usage', help='file to write interval weights '
+                         'of joint estimates to')
+    command.set_defaults(function=merge)
+
+    return parser
+
+def main(argv=None):
+    arguments = parser().parse_args(argv)
+    try:
+        arguments.function(arguments)
+    except BrokenPipeError:
+        # Downstream stage exited early (e.g. head): Send what is left to
+        # flush at exit to /dev/null (see the Python signal documentation)
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        sys.exit(1)
+    return 0
+
+
+########
+# main #
+########
+
+# Only run the following code if this module is run directly
+if __name__ == '__main__':
+    sys.exit(main())
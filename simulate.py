@@ -46,10 +46,12 @@ def simulate_reads(genes, pAi, f_size, f_prob, reads_per_gene=100, pAlen=42,
             fragment_sizes[gene][n_simulated:(n_simulated
                                               + n_to_simulate)] = size
             n_simulated += n_to_simulate
-        for read in range(n_simulated, reads_per_gene):
-            r=np.random.random()
-            fragment_sizes[gene][read] = f_size[[i for i in range(len(f_cum))
-                                                 if r <= f_cum[i]][0]]
+        # Draw the remaining fragment sizes from the cumulative profile
+        # (first size whose cumulative probability reaches r)
+        r = np.random.random(reads_per_gene - n_simulated)
+        fragment_sizes[gene][n_simulated:reads_per_gene] = \
+            np.asarray(f_size)[np.minimum(np.searchsorted(f_cum, r),
+                                          len(f_cum) - 1)]
         np.random.shuffle(fragment_sizes[gene])
         pAoffsets[gene] = np.zeros(reads_per_gene, dtype=int)
         n_to_simulate = int(reads_per_gene / (pAlen - min_offset + 1))
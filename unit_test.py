@@ -33,12 +33,53 @@ import unittest
 import os
 from estimate_length import *
 from simulate import *
+from pAi_store import *
+from bam import *
+from genome import *
+from differential import *
+from calibrate import *
+from distribute import *
+import io
 import sys
 import subprocess
+import gzip
+import tempfile
+import struct
+import zlib
+import time
+import threading
 from scipy.stats import power_divergence
 from scipy.stats import pearsonr
 
 
+#############
+# functions #
+#############
+
+def bgzf_compress(data, block_size=65280):
+    """Compresses data into BGZF blocks (followed by the EOF block)."""
+    blocks = []
+    for start in list(range(0, len(data), block_size)) + [len(data)]:
+        chunk = data[start:(start + block_size)]
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+        compressed = compressor.compress(chunk) + compressor.flush()
+        blocks.append(b'\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff'
+                      + struct.pack('<HBBHH', 6, 66, 67, 2,
+                                    len(compressed) + 25)
+                      + compressed
+                      + struct.pack('<II', zlib.crc32(chunk), len(chunk)))
+    return b''.join(blocks)
+
+def bam_record(reference, position, flag, tags):
+    """Encodes a BAM record without CIGAR, sequence and qualities with the
+       given Z type tags."""
+    data = struct.pack('<iiBBHHHiiii', reference, position, 2, 255, 4680,
+                       0, flag, 0, -1, -1, 0) + b'r\x00'
+    for tag, value in tags:
+        data += tag.encode() + b'Z' + value.encode() + b'\x00'
+    return struct.pack('<i', len(data)) + data
+
+
 ##############
 # parameters #
 ##############
@@ -130,10 +171,9 @@ if not(os.path.isfile(os.path.join(folder_out, 'utr_annotation.bed'))):
         subprocess.call('wget ' + gtf_url + ' -O - | zcat | grep "^9\t" | gzip --best > ' + gtf, shell=True)
 
     # taken from pipeline.py:
-    old_stdout = sys.stdout
-    sys.stdout = open(os.path.join(folder_out, 'utr_annotation_temp.bed'), 'w')
-    extract_three_prime_utr_information(gtf, bed_name_attributes = ["gene_name"])
-    sys.stdout = old_stdout
+    with open(os.path.join(folder_out, 'utr_annotation_temp.bed'), 'w') as utr_bed:
+        extract_three_prime_utr_information(gtf, bed_name_attributes = ["gene_name"],
+                                            output = utr_bed)
 
     ### 1.1 Clean utr from haplotypes and junk chromosomes
     with open(os.path.join(folder_out, 'utr_annotation_temp.bed'), 'r') as fin, open(os.path.join(folder_out, 'utr_annotation_unsorted.bed'), 'w') as fout:
@@ -295,6 +335,636 @@ class TestStringMethods(unittest.TestCase):
             self.assertTrue(all(probs_estimated[gene] == probs_simulated) or
                             (r >= r_threshold and p_val <= alpha_cor))
 
+    def test_collapse_pcr_duplicates_removes_identical_reads(self):
+        self.assertEqual(collapse_pcr_duplicates([['5', '+', 'A'],
+                                                  ['3', '+', 'A'],
+                                                  ['5', '+', 'A'],
+                                                  ['5', '+', 'C']]),
+                         [['3', '+', 'A'], ['5', '+', 'A'], ['5', '+', 'C']])
+
+    def test_read_bamfile_by_gene_groups_reads(self):
+        with tempfile.TemporaryDirectory() as folder:
+            bamfile = os.path.join(folder, 'bamfile.txt.gz')
+            with gzip.open(bamfile, 'wt') as f:
+                for gene, position in [('A', 1), ('A', 2), ('B', 3)]:
+                    columns = ['.'] * 19
+                    columns[3] = str(position)
+                    columns[11] = '+'
+                    columns[12] = 'XX:Z:GE:' + gene
+                    columns[18] = 'UMI'
+                    f.write('\t'.join(columns) + '\n')
+            self.assertEqual(list(read_bamfile_by_gene(bamfile)),
+                             [('A', [['1', '+', 'UMI'], ['2', '+', 'UMI']]),
+                              ('B', [['3', '+', 'UMI']])])
+
+    def test_streaming_estimation_matches_reference_estimation(self):
+        gene_pAi = {'gene' : [pAi[2]]}
+        gene_reads = [[str(read), '+', 'UMI'] for read in reads]
+        estimates = list(estimate_tail_lengths_streaming(
+            [('other', gene_reads), ('gene', gene_reads + gene_reads)],
+            ['gene'], gene_pAi, Lrange, f_size, f_prob, min_reads=1))
+        self.assertEqual([(gene, gene_reads) for gene, gene_reads, probs
+                          in estimates], [('gene', reads)])
+        self.assertTrue(np.allclose(estimates[0][2],
+                                    estimate_poly_tail_length(
+                                        reads, Lrange, gene_pAi['gene'], 0,
+                                        f_size, f_prob, False),
+                                    rtol=1e-9, atol=10**-PRECISION))
+        # probs_estimated holds estimate_poly_tail_length of the simulated
+        # genes
+        estimates = list(estimate_tail_lengths_streaming(
+            ((gene, [[read] for read in reads_sim[gene]]) for gene in genes),
+            probs_estimated, pAi_sim, tail_range_sim, f_size, f_prob,
+            collapse_duplicates=False))
+        self.assertEqual(len(estimates), len(probs_estimated))
+        for gene, gene_reads, probs in estimates:
+            self.assertTrue(np.allclose(probs, probs_estimated[gene],
+                                        rtol=1e-9, atol=10**-PRECISION))
+
+    def test_streaming_estimation_matches_table_estimation(self):
+        gene_pAi = {'gene' : [pAi[2]]}
+        gene_reads = [[str(read), '+', 'UMI'] for read in reads]
+        for queue_size in [0, 2]:
+            estimates = list(estimate_tail_lengths_streaming(
+                [('other', gene_reads), ('gene', gene_reads + gene_reads)],
+                ['gene'], gene_pAi, Lrange, f_size, f_prob, min_reads=1,
+                queue_size=queue_size))
+            self.assertEqual(estimates,
+                             [('gene', reads,
+                               estimate_poly_tail_length_table(
+                                   reads, Lrange, gene_pAi['gene'], 0, f_size,
+                                   f_prob))])
+
+
+    def test_interval_kernel_matches_prob_d_given_L(self):
+        kernel = interval_kernel(reads, pAi, Lrange, f_size, f_prob)[:, 2, :]
+        kernel = kernel / kernel.sum(axis=1)[:, None]
+        for read, read_kernel in zip(reads, kernel):
+            for length, prob in zip(Lrange, read_kernel):
+                self.assertAlmostEqual(prob, prob_d_given_L(read, pAi, 2,
+                                                            length, f_size,
+                                                            f_prob, Lrange),
+                                       PRECISION)
+
+    def test_interval_kernel_matches_prob_d_given_pAi(self):
+        pAi_only = [dict(interval, is_tail=False) for interval in pAi]
+        kernel = interval_kernel(reads, pAi_only, Lrange, f_size, f_prob)
+        for read, read_kernel in zip(reads, kernel):
+            for interval in range(len(pAi)):
+                self.assertAlmostEqual(read_kernel[interval, 0]
+                                       / read_kernel[:, 0].sum(),
+                                       prob_d_given_pAi(read, pAi, interval,
+                                                        f_size, f_prob),
+                                       PRECISION)
+
+    def test_pAi_usage_and_tail_length_probs_summing_to_one(self):
+        weights, probs = estimate_pAi_usage_and_tail_length(reads, Lrange, pAi,
+                                                            f_size, f_prob)
+        self.assertEqual(round(sum(weights), PRECISION), 1)
+        self.assertEqual(round(sum(probs), PRECISION), 1)
+
+    def test_pAi_usage_recovers_simulated_mixture(self):
+        for gene in genes:
+            tail = pAi_sim[gene][0]
+            # Internal priming site within reach of the largest fragments
+            upstream = {'start' : int(tail['start']) - 500,
+                        'end' : int(tail['start']) - 480,
+                        'strand' : tail['strand'], 'is_tail' : False}
+            primed = simulate_reads(['primed'],
+                                    {'primed' : [dict(upstream,
+                                                      is_tail=True)]},
+                                    f_size, f_prob, 600, 20)[2]['primed']
+            mixture = list(reads_sim[gene]) + list(primed)
+            weights, probs = estimate_pAi_usage_and_tail_length(
+                mixture, tail_range_sim, [upstream, tail], f_size, f_prob)
+            primed_fraction = len(primed) / len(mixture)
+            self.assertTrue(np.allclose(weights, [primed_fraction,
+                                                  1 - primed_fraction],
+                                        rtol=0, atol=.03))
+
+
+    def test_pAi_store_round_trip_and_overlap_queries(self):
+        intervals = [('9', 100, 110, 'A', '+'), ('9', 50, 90, 'A', '+'),
+                     ('9', 105, 108, 'B', '+'), ('9', 100, 110, 'C', '-'),
+                     ('10', 5, 15, '.', '+')]
+        with tempfile.TemporaryDirectory() as folder:
+            bed = os.path.join(folder, 'pAi.bed')
+            with open(bed, 'w') as f:
+                for interval in intervals:
+                    f.write('%s\t%i\t%i\t%s\t%s\n' % interval)
+            write_pAi_store(bed, os.path.join(folder, 'store'))
+            store = open_pAi_store(os.path.join(folder, 'store'))
+            for chromosome, strand, start, end in [('9', '+', 0, 200),
+                                                   ('9', '+', 89, 101),
+                                                   ('9', '+', 106, 107),
+                                                   ('9', '+', 90, 100),
+                                                   ('9', '-', 0, 100),
+                                                   ('10', '-', 0, 100),
+                                                   ('X', '+', 0, 100)]:
+                expected = sorted((interval[1], interval[2], interval[3])
+                                  for interval in intervals
+                                  if interval[0] == chromosome
+                                  and interval[4] == strand
+                                  and interval[1] < end
+                                  and interval[2] > start)
+                self.assertEqual(sorted((pAi_interval['start'],
+                                         pAi_interval['end'],
+                                         pAi_interval['name'])
+                                        for pAi_interval
+                                        in query_pAi_store(store, chromosome,
+                                                           strand, start,
+                                                           end)),
+                                 expected)
+            export_pAi_store(store, os.path.join(folder, 'exported.bed'))
+            with open(os.path.join(folder, 'exported.bed'), 'r') as f:
+                self.assertEqual(sorted(f.readlines()),
+                                 sorted('%s\t%i\t%i\t%s\t%s\n' % interval
+                                        for interval in intervals))
+
+
+    def test_tail_length_posteriors_match_estimate_poly_tail_length(self):
+        unique_reads, counts, log_kernel, zero = offset_log_likelihoods(
+            reads, Lrange, pAi, 2, f_size, f_prob)
+        posterior = tail_length_posteriors(counts[None, :], log_kernel, zero)
+        for prob, expected in zip(posterior[0],
+                                  estimate_poly_tail_length(reads, Lrange, pAi,
+                                                            2, f_size, f_prob,
+                                                            False)):
+            self.assertAlmostEqual(prob, expected, PRECISION)
+
+    def test_bootstrap_intervals_contain_estimates(self):
+        bootstrap = bootstrap_tail_length(reads_sim[genes[0]], tail_range_sim,
+                                          pAi_sim[genes[0]], 0, f_size, f_prob,
+                                          replicates=200)
+        for statistic in ['map', 'mean']:
+            estimate, lower, upper = bootstrap[statistic]
+            self.assertTrue(lower <= estimate <= upper)
+        self.assertEqual(bootstrap['map'][0],
+                         tail_range_sim[np.argmax(probs_estimated[genes[0]])])
+
+    def test_banded_bootstrap_matches_table_bootstrap(self):
+        offsets = np.arange(-700, 1000, 7)
+        table = banded_likelihood_table(Lrange, f_size, f_prob)
+        self.assertTrue(np.allclose(banded_kernel(table,
+                                                  banded_rows(table, offsets),
+                                                  Lrange),
+                                    offset_kernel(offsets, Lrange, f_size,
+                                                  f_prob),
+                                    rtol=1e-12, atol=0))
+        bootstraps = []
+        for banded in [False, True]:
+            np.random.seed(42)
+            bootstraps.append(bootstrap_tail_length(
+                reads_sim[genes[0]], tail_range_sim, pAi_sim[genes[0]], 0,
+                f_size, f_prob, replicates=200, banded=banded))
+        for statistic in ['map', 'mean']:
+            self.assertTrue(np.allclose(bootstraps[0][statistic],
+                                        bootstraps[1][statistic],
+                                        rtol=1e-9, atol=0))
+
+
+    def test_likelihood_table_matches_interval_kernel(self):
+        kernel = interval_kernel(reads, pAi, Lrange, f_size, f_prob)[:, 2, :]
+        table_kernel = offset_kernel(650 - np.array(reads), Lrange, f_size,
+                                     f_prob)
+        self.assertTrue(np.allclose(kernel, table_kernel, rtol=0, atol=1e-15))
+
+    def test_estimate_poly_tail_length_table_matches_reference(self):
+        # Log-likelihoods are summed over thousands of reads, so compare
+        # with a relative tolerance
+        self.assertTrue(np.allclose(estimate_poly_tail_length_table(
+                                        reads_sim[genes[0]], tail_range_sim,
+                                        pAi_sim[genes[0]], 0, f_size, f_prob),
+                                    probs_estimated[genes[0]], rtol=1e-9,
+                                    atol=10**-PRECISION))
+
+    def test_likelihood_table_is_reused_from_cache_dir(self):
+        likelihood_tables.clear()
+        with tempfile.TemporaryDirectory() as folder:
+            min_offset, table = likelihood_table(Lrange, f_size, f_prob,
+                                                 folder)
+            cache_files = os.listdir(folder)
+            self.assertEqual(len(cache_files), 1)
+            likelihood_tables.clear()
+            self.assertTrue(np.array_equal(likelihood_table(Lrange, f_size,
+                                                            f_prob,
+                                                            folder)[1],
+                                           table))
+            self.assertEqual(os.listdir(folder), cache_files)
+
+
+    def test_write_atomically_leaves_no_partial_files(self):
+        with tempfile.TemporaryDirectory() as folder:
+            filename = os.path.join(folder, 'table.npy')
+            with self.assertRaises(ValueError):
+                write_atomically(filename, lambda f: f.write(b'x')
+                                 and int('partial'))
+            self.assertEqual(os.listdir(folder), [])
+            write_atomically(filename, lambda f: np.save(f, np.arange(3)))
+            self.assertEqual(os.listdir(folder), ['table.npy'])
+            self.assertTrue(np.array_equal(np.load(filename), np.arange(3)))
+
+    def test_banded_likelihood_table_matches_likelihood_table(self):
+        likelihood_tables.clear()
+        min_offset, table = likelihood_table(Lrange, f_size, f_prob)
+        with tempfile.TemporaryDirectory() as folder:
+            banded = banded_likelihood_table(Lrange, f_size, f_prob, folder)
+            likelihood_tables.clear()
+            cached = banded_likelihood_table(Lrange, f_size, f_prob, folder)
+        self.assertEqual(banded['min_offset'], min_offset)
+        self.assertEqual((cached['band'] != banded['band']).nnz, 0)
+        rows = np.arange(len(table) + 1)
+        for column, length in enumerate(Lrange):
+            vector = np.zeros(len(Lrange))
+            vector[column] = 1
+            self.assertTrue(np.allclose(banded_dot(cached, rows, vector,
+                                                   Lrange),
+                                        np.append(table[:, column], 0),
+                                        rtol=1e-12, atol=0))
+        self.assertLess(banded['band'].nnz, table.size)
+
+    def test_banded_estimates_match_table_and_kernel_estimates(self):
+        self.assertTrue(np.allclose(estimate_poly_tail_length_banded(
+                                        reads_sim[genes[0]], tail_range_sim,
+                                        pAi_sim[genes[0]], 0, f_size, f_prob),
+                                    estimate_poly_tail_length_table(
+                                        reads_sim[genes[0]], tail_range_sim,
+                                        pAi_sim[genes[0]], 0, f_size, f_prob),
+                                    rtol=1e-9, atol=10**-PRECISION))
+        for estimate, banded_estimate in zip(
+                estimate_pAi_usage_and_tail_length(reads, Lrange, pAi,
+                                                   f_size, f_prob),
+                estimate_pAi_usage_and_tail_length_banded(reads, Lrange, pAi,
+                                                          f_size, f_prob)):
+            self.assertTrue(np.allclose(estimate, banded_estimate,
+                                        rtol=1e-9, atol=10**-PRECISION))
+
+
+    def test_scan_pAi_merges_windows_per_strand(self):
+        genome = ['>9 dna\n', 'CCCCAAAAAAAAGGGG\n', 'CCCTTTTTTTCC\n',
+                  '>10\n', 'AAAAAAAA\n']
+        self.assertEqual(list(scan_pAi(genome, 8, 7, 6)),
+                         [('9', 2, 14, '+'), ('9', 17, 28, '-'),
+                          ('10', 0, 8, '+')])
+
+    def test_annotate_pAi_requires_containment_and_strand(self):
+        spans = utr_gene_spans(['9\t100\t200\tA\t+\t0\n',
+                                '9\t150\t300\tA\t+\t0\n',
+                                '9\t100\t200\tB\t-\t0\n'])
+        self.assertEqual(spans, {('9', '+') : [(100, 300, 'A')],
+                                 ('9', '-') : [(100, 200, 'B')]})
+        pAi_bed = ['9\t250\t260\t.\t+\n', '9\t250\t260\t.\t-\n',
+                   '9\t290\t310\t.\t+\n', '9\t100\t110\t.\t-\n']
+        self.assertEqual(list(annotate_pAi(pAi_bed, spans)),
+                         [('9', 250, 260, 'A', '+'),
+                          ('9', 100, 110, 'B', '-')])
+
+    def test_single_utr_no_pAi_genes_selected_in_process(self):
+        gtf_lines = ['#!header\n']
+        for gene, utrs in [('A', 1), ('B', 2), ('C', 1)]:
+            gtf_lines += ['9\te\tthree_prime_utr\t1\t2\t.\t+\t.\t'
+                          'gene_id "%s1"; gene_name "%s";\n' % (gene, gene)] * utrs
+        self.assertEqual(single_utr_no_pAi_genes(gtf_lines,
+                                                 ['9\t1\t2\tC\t+\n']),
+                         ['A'])
+
+
+    def test_closed_downstream_pipe_fails_quietly(self):
+        with tempfile.TemporaryFile() as genome:
+            genome.write(b'>9\n' + b'AAAAAAAACCCCCCCCCC\n' * 200000)
+            genome.seek(0)
+            process = subprocess.Popen([sys.executable, 'polyA.py',
+                                        'scan-pai'], stdin=genome,
+                                       stdout=subprocess.PIPE,
+                                       stderr=subprocess.PIPE)
+            self.assertEqual(process.stdout.readline(), b'9\t0\t12\t.\t+\n')
+            process.stdout.close()
+            self.assertEqual(process.wait(), 1)
+            self.assertEqual(process.stderr.read(), b'')
+            process.stderr.close()
+
+    def test_text_stages_do_not_import_numpy(self):
+        # Checked in a fresh interpreter, numpy is loaded here already
+        self.assertEqual(subprocess.check_output(
+            [sys.executable, '-c', 'import sys, annotation; '
+             'print(sorted(module for module in sys.modules if module in '
+             '["numpy", "scipy", "concurrent.futures"]))']), b'[]\n')
+
+    def test_read_blocks_and_lines_for_plain_gzip_and_bgzf_files(self):
+        data = ''.join('read %i \u00e9 %s\n' % (i, 'x' * (i % 50))
+                       for i in range(20000)).encode()
+        with tempfile.TemporaryDirectory() as folder:
+            files = {'plain.txt' : data,
+                     'members.txt.gz' : (gzip.compress(data[:100001])
+                                         + gzip.compress(data[100001:])),
+                     'bgzf.txt.gz' : bgzf_compress(data, 10000)}
+            for name, content in files.items():
+                with open(os.path.join(folder, name), 'wb') as f:
+                    f.write(content)
+                self.assertEqual(b''.join(read_blocks(os.path.join(folder,
+                                                                   name),
+                                                      block_size=1 << 16,
+                                                      queue_size=2,
+                                                      threads=3)),
+                                 data)
+                self.assertEqual(list(read_lines(os.path.join(folder, name),
+                                                 block_size=777)),
+                                 data.decode().splitlines(True))
+                with open_file(os.path.join(folder, name)) as f:
+                    self.assertEqual(list(f), data.decode().splitlines(True))
+
+    def test_read_lines_detects_bgzf_fed_through_a_pipe_in_pieces(self):
+        text = ''.join('line %i\n' % line for line in range(20000))
+        compressed = bgzf_compress(text.encode())
+        with tempfile.TemporaryDirectory() as folder:
+            fifo = os.path.join(folder, 'fifo')
+            os.mkfifo(fifo)
+            def feed():
+                with open(fifo, 'wb', buffering=0) as f:
+                    # Header byte by byte, so that a single read of the
+                    # pipe sees only part of it
+                    for position in range(20):
+                        f.write(compressed[position:(position + 1)])
+                        time.sleep(.01)
+                    f.write(compressed[20:])
+            writer = threading.Thread(target=feed)
+            writer.start()
+            self.assertEqual(''.join(read_lines(fifo)), text)
+            writer.join()
+
+    def test_read_lines_fails_on_truncated_gzip_files(self):
+        data = ''.join('read %i\n' % i for i in range(20000)).encode()
+        with tempfile.TemporaryDirectory() as folder:
+            for name, content in [('gzip.txt.gz', gzip.compress(data)),
+                                  ('bgzf.txt.gz', bgzf_compress(data, 10000))]:
+                with open(os.path.join(folder, name), 'wb') as f:
+                    f.write(content[:(len(content) // 2)])
+                with self.assertRaises((EOFError, ValueError, zlib.error)):
+                    list(read_lines(os.path.join(folder, name),
+                                    block_size=777))
+
+
+    def test_bam_reader_with_and_without_index(self):
+        header = b'BAM\x01' + struct.pack('<i', 0) + struct.pack('<i', 2)
+        for name in [b'9', b'10']:
+            header += struct.pack('<i', len(name) + 1) + name + b'\x00' \
+                      + struct.pack('<i', 10**6)
+        records = [(0, 99, 0, [('GE', 'A'), ('XM', 'U1')]),
+                   (0, 150, 16, [('XM', 'U2'), ('GE', 'A')]),
+                   (0, 160, 0, [('GE', 'B'), ('XM', 'U3')]),
+                   (0, 400, 0, [('GE', 'A'), ('XM', 'U4')]),
+                   (1, 120, 0, [('GE', 'A'), ('XM', 'U5')])]
+        spans = {('9', '+') : [(100, 300, 'A'), (100, 300, 'B')],
+                 ('10', '+') : [(100, 300, 'A')], ('X', '+') : [(0, 1, 'C')]}
+        expected = [('A', [['121', '+', 'U5']]), ('A', [['151', '-', 'U2']]),
+                    ('B', [['161', '+', 'U3']]), ('C', [])]
+        with tempfile.TemporaryDirectory() as folder:
+            bamfile = os.path.join(folder, 'reads.bam')
+            # One BGZF block for the header and one per record
+            blocks = [bgzf_compress(header)[:-28]]
+            for record in records:
+                blocks.append(bgzf_compress(bam_record(*record))[:-28])
+            with open(bamfile, 'wb') as f:
+                f.write(b''.join(blocks) + bgzf_compress(b''))
+            reads = read_bam(bamfile)
+            self.assertEqual(list(reads['position']), [100, 151, 161, 401, 121])
+            self.assertEqual(list(reads['strand']), ['+', '-', '+', '+', '+'])
+            self.assertEqual(list(reads['reference']), ['9'] * 4 + ['10'])
+            self.assertEqual(list(reads['umi']), ['U1', 'U2', 'U3', 'U4', 'U5'])
+            self.assertEqual(sorted(read_bam_by_gene(bamfile, spans)),
+                             expected)
+
+            # BAI with all records of a reference in bin 0 and no linear
+            # index
+            offsets = np.cumsum([len(block) for block in blocks])
+            index = b'BAI\x01' + struct.pack('<i', 2)
+            for first, last in [(1, 5), (5, 6)]:
+                index += struct.pack('<iIiQQi', 1, 0, 1, offsets[first - 1] << 16,
+                                     offsets[last - 1] << 16, 0)
+            with open(bamfile + '.bai', 'wb') as f:
+                f.write(index)
+            self.assertEqual(sorted(read_bam_by_gene(bamfile, spans)),
+                             expected)
+
+
+    def test_parameter_sweep_over_genome_cache_matches_scan_pAi(self):
+        bases = ['A', 'C', 'G', 'T', 'a', 'N', 'AAAAAAA', 'TTTTTT', 'AATAAA']
+        genome = []
+        for chromosome in ['9', '10', 'MT']:
+            sequence = ''.join(np.random.choice(bases, 500))
+            genome.append('>%s dna\n' % chromosome)
+            genome += [sequence[i:(i + 60)] + '\n'
+                       for i in range(0, len(sequence), 60)]
+        parameters = [(10, 7, 6), (8, 5, 4), (12, 9, 3), (3, 2, 5)]
+        with tempfile.TemporaryDirectory() as folder:
+            with open(os.path.join(folder, 'genome.fa'), 'w') as f:
+                f.writelines(genome)
+            pack_genome(os.path.join(folder, 'genome.fa'),
+                        os.path.join(folder, 'cache'))
+            for chunk_size in [1 << 24, 97]:
+                pAi_sweep = scan_pAi_parameters(os.path.join(folder, 'cache'),
+                                                parameters, chunk_size)
+                for parameter in parameters:
+                    self.assertEqual(pAi_sweep[parameter],
+                                     list(scan_pAi(genome, *parameter)))
+
+
+    def test_benjamini_hochberg_adjustment(self):
+        self.assertTrue(np.allclose(benjamini_hochberg([.01, .04, np.nan,
+                                                        .03, .5]),
+                                    [.04, .04 * 4 / 3, np.nan, .04 * 4 / 3,
+                                     .5],
+                                    equal_nan=True))
+
+    def test_differential_tail_length_detects_shifted_tails(self):
+        gene_pAi = {'same' : [pAi[2]], 'shifted' : [pAi[2]]}
+        conditions = ['control'] * 3 + ['treated'] * 3
+        samples = []
+        for condition in conditions:
+            tail_length = 120 if condition == 'treated' else 40
+            samples.append({'same' : reads,
+                            'shifted' : simulate_reads(['shifted'], gene_pAi,
+                                                       f_size, f_prob, 300,
+                                                       tail_length)[2]
+                                                      ['shifted']})
+        results = differential_tail_length(samples,
+                                           {'same' : 650, 'shifted' : 650},
+                                           conditions, Lrange, f_size, f_prob,
+                                           permutations=200)
+        effect, statistic, p_value, adjusted = results['same']
+        self.assertAlmostEqual(effect, 0, PRECISION)
+        self.assertEqual(p_value, 1)
+        effect, statistic, p_value, adjusted = results['shifted']
+        self.assertGreater(effect, 0)
+        # 3 vs. 3 samples allow for 20 labelings, 2 as extreme as observed
+        self.assertLess(p_value, .25)
+
+
+    def test_streaming_estimation_caps_and_stops_early(self):
+        gene = genes[0]
+        gene_reads = [[read] for read in reads_sim[gene]]
+        def estimate(**kwargs):
+            return list(estimate_tail_lengths_streaming(
+                [(gene, gene_reads)], [gene], pAi_sim, tail_range_sim,
+                f_size, f_prob, collapse_duplicates=False, **kwargs))[0][1:]
+        for banded in [False, True]:
+            used, probs = estimate(banded=banded, stop_probability=2)
+            self.assertEqual(sorted(used), sorted(reads_sim[gene]))
+            self.assertTrue(np.allclose(probs, probs_estimated[gene],
+                                        rtol=1e-9, atol=10**-PRECISION))
+            self.assertEqual(len(estimate(banded=banded, max_reads=500)[0]),
+                             500)
+            self.assertEqual(len(estimate(banded=banded,
+                                          stop_probability=0)[0]), 50)
+        with self.assertRaises(ValueError):
+            estimate(joint=True, stop_probability=.99)
+
+    def test_calibration_reports_every_combination(self):
+        settings = [{'bin_size' : 10, 'tail_step' : 30},
+                    {'bin_size' : 5, 'tail_step' : 10, 'max_reads' : 50,
+                     'stop_probability' : .99, 'banded' : True}]
+        report = calibrate(np.array(bio_size), np.array(bio_intensity),
+                           [(40, 5), (80, 5)], [100], settings, n_genes=5)
+        self.assertEqual(len(report), 4)
+        for row in report:
+            self.assertEqual(sorted(row), sorted(report_columns))
+            self.assertTrue(0 <= row['interval_coverage'] <= 1)
+            self.assertGreaterEqual(row['map_rmse'], abs(row['map_bias']))
+            if row['banded']:
+                self.assertLessEqual(row['reads_used'], 50)
+
+
+    def test_work_queue_leases_expire_and_are_retried(self):
+        with tempfile.TemporaryDirectory() as folder:
+            queue = os.path.join(folder, 'queue')
+            with open(os.path.join(folder, 'reads.txt'), 'w') as f:
+                pass
+            create_queue(queue, ['A', 'B', 'C'], 2,
+                         {'reads' : os.path.join(folder, 'reads.txt'),
+                          'format' : 'coordinates'})
+            self.assertEqual(read_manifest(queue),
+                             [('chunk000000', ['A', 'B']),
+                              ('chunk000001', ['C'])])
+            self.assertEqual(claim_chunk(queue, 'w1'),
+                             ('chunk000000', ['A', 'B'], 1))
+            self.assertEqual(claim_chunk(queue, 'w2')[::2],
+                             ('chunk000001', 1))
+            self.assertIsNone(claim_chunk(queue, 'w3'))
+            # w1 stops renewing its lease
+            os.utime(lease_file(queue, 'chunk000000', 1), (0, 0))
+            self.assertEqual(claim_chunk(queue, 'w3', max_attempts=2)[::2],
+                             ('chunk000000', 2))
+            # Workers that saw the expired lease cannot claim it any more
+            self.assertFalse(create_lease(queue, 'chunk000000', 'w4', 2))
+            with open(lease_file(queue, 'chunk000000', 2), 'r') as f:
+                self.assertEqual(f.read(), 'w3\n')
+            os.utime(lease_file(queue, 'chunk000000', 2), (0, 0))
+            self.assertIsNone(claim_chunk(queue, 'w4', max_attempts=2))
+            self.assertEqual(missing_chunks(queue),
+                             ['chunk000000', 'chunk000001'])
+            with self.assertRaises(ValueError):
+                merge_results(queue, io.StringIO())
+
+    def test_work_queue_is_not_created_over_an_existing_one(self):
+        with tempfile.TemporaryDirectory() as folder:
+            queue = os.path.join(folder, 'queue')
+            with open(os.path.join(folder, 'reads.txt'), 'w') as f:
+                pass
+            settings = {'reads' : os.path.join(folder, 'reads.txt'),
+                        'format' : 'coordinates'}
+            create_queue(queue, ['A', 'B', 'C'], 2, settings)
+            with open(result_file(queue, 'chunk000000'), 'w') as f:
+                f.write('stale')
+            with self.assertRaises(ValueError):
+                create_queue(queue, ['D', 'E'], 2, settings)
+            self.assertEqual(read_manifest(queue)[0],
+                             ('chunk000000', ['A', 'B']))
+
+    def test_work_queue_requires_indexed_bam(self):
+        with tempfile.TemporaryDirectory() as folder:
+            queue = os.path.join(folder, 'queue')
+            bamfile = os.path.join(folder, 'reads.bam')
+            with open(bamfile, 'wb') as f:
+                pass
+            with self.assertRaises(ValueError):
+                create_queue(queue, ['A'], 1, {'reads' : bamfile,
+                                               'format' : 'bam'})
+            self.assertFalse(os.path.exists(queue))
+
+    def test_work_queue_splits_text_reads_by_chunk(self):
+        with tempfile.TemporaryDirectory() as folder:
+            queue = os.path.join(folder, 'queue')
+            settings = {'reads' : os.path.join(folder, 'reads.txt'),
+                        'format' : 'coordinates'}
+            with open(settings['reads'], 'w') as f:
+                f.write('C,7, 8\nX,1\nA,2\nB,3, 4\nD,5')
+            create_queue(queue, ['A', 'B', 'C', 'D', 'E'], 2, settings)
+            self.assertEqual(sorted(os.listdir(os.path.join(queue,
+                                                            'reads'))),
+                             ['chunk000000.txt.gz', 'chunk000001.txt.gz'])
+            self.assertEqual([list(chunk_reads(queue, chunk, settings,
+                                               chunk_genes))
+                              for chunk, chunk_genes in read_manifest(queue)],
+                             [[('A', [['2']]), ('B', [['3'], ['4']])],
+                              [('C', [['7'], ['8']]), ('D', [['5']])],
+                              []])
+        with tempfile.TemporaryDirectory() as folder:
+            settings['reads'] = os.path.join(folder, 'reads.txt')
+            with open(settings['reads'], 'w') as f:
+                f.write('A,1\nB,2\nA,3\n')
+            with self.assertRaises(ValueError):
+                create_queue(os.path.join(folder, 'queue'), ['A', 'B'], 1,
+                             settings)
+
+    def test_estimate_chunk_renews_lease_for_every_gene_read(self):
+        calls = []
+        reads_by_gene = renewing(iter([(gene, reads_sim[gene])
+                                       for gene in genes]),
+                                 lambda: calls.append(len(calls)))
+        self.assertEqual(next(reads_by_gene)[0], genes[0])
+        self.assertEqual(calls, [0])
+        self.assertEqual([gene for gene, reads in reads_by_gene], genes[1:])
+        self.assertEqual(len(calls), len(genes))
+
+    def test_workers_in_separate_processes_estimate_all_chunks(self):
+        with tempfile.TemporaryDirectory() as folder:
+            with open(os.path.join(folder, 'reads.txt'), 'w') as f:
+                for gene in genes:
+                    f.write(gene + ',' + ', '.join(str(read) for read
+                                                   in reads_sim[gene]) + '\n')
+            with open(os.path.join(folder, 'pAi_gene.bed'), 'w') as f:
+                pass
+            queue = os.path.join(folder, 'queue')
+            create_queue(queue, genes, 2,
+                         {'utr' : os.path.join(folder_out,
+                                               'utr_annotation.bed'),
+                          'pai' : os.path.join(folder, 'pAi_gene.bed'),
+                          'bioanalyzer' : os.path.join(
+                              folder_in, 'ds_012_50fix_bioanalyzer.txt'),
+                          'bin_size' : 5, 'tail_range' : [2, 63, 10],
+                          'reads' : os.path.join(folder, 'reads.txt'),
+                          'format' : 'coordinates', 'min_reads' : 100,
+                          'joint' : False, 'banded' : False,
+                          'cache_dir' : None, 'max_reads' : None,
+                          'stop_probability' : None})
+            workers = [subprocess.Popen([sys.executable, 'polyA.py', 'work',
+                                         queue, '--worker', 'w%i' % worker])
+                       for worker in range(3)]
+            self.assertEqual([worker.wait() for worker in workers],
+                             [0, 0, 0])
+            self.assertEqual(os.listdir(os.path.join(queue, 'leases')), [])
+            merged = io.StringIO()
+            merge_results(queue, merged)
+        estimates = [line.split(',', 1) for line
+                     in merged.getvalue().splitlines()]
+        self.assertEqual([gene for gene, probs in estimates], genes)
+        for gene, probs in estimates:
+            self.assertTrue(np.allclose([float(value) for value
+                                         in probs.strip('[]').split(',')],
+                                        probs_estimated[gene], rtol=1e-9,
+                                        atol=10**-PRECISION))
+
+
 
 #######
 # run #